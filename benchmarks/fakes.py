@@ -0,0 +1,233 @@
+"""In-process fakes for the services the toolkit talks to: IMDSv2, SecretsManager,
+CloudWatch Logs and the enclave side of a VSOCK connection.
+
+Every fake counts the requests it serves so benchmarks can report calls per
+operation alongside latency.
+"""
+import collections
+import json
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class _QuietHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, status, body, content_type="text/plain"):
+        data = body.encode() if isinstance(body, str) else body
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def read_body(self):
+        length = int(self.headers.get("Content-Length", 0))
+        return self.rfile.read(length) if length else b""
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        pass  # Clients dropping kept-alive connections at exit are expected
+
+
+class FakeServer:
+    """A ThreadingHTTPServer on an ephemeral loopback port, run from a daemon thread"""
+
+    handler = None
+
+    def __init__(self):
+        self.calls = collections.Counter()
+        self.lock = threading.Lock()
+        fake = self
+
+        class Handler(self.handler):
+            server_fake = fake
+
+        self.httpd = _Server(("127.0.0.1", 0), Handler)
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.httpd.server_address[1]}"
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.calls[name] += amount
+
+    def reset(self):
+        with self.lock:
+            self.calls.clear()
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class _ImdsHandler(_QuietHandler):
+    ROLE = "bench-role"
+
+    def do_PUT(self):
+        self.read_body()
+        if self.path == "/latest/api/token":
+            self.server_fake.count("token")
+            self.reply(200, "bench-imds-token")
+        else:
+            self.reply(404, "")
+
+    def do_GET(self):
+        if self.headers.get("X-aws-ec2-metadata-token") != "bench-imds-token":
+            self.reply(401, "")
+            return
+        if self.path == "/latest/meta-data/iam/security-credentials/":
+            self.server_fake.count("role")
+            self.reply(200, self.ROLE)
+        elif self.path == f"/latest/meta-data/iam/security-credentials/{self.ROLE}":
+            self.server_fake.count("credentials")
+            expiration = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(time.time() + 6 * 3600))
+            self.reply(200, json.dumps({
+                "Code": "Success",
+                "Type": "AWS-HMAC",
+                "AccessKeyId": "ASIABENCHMARKKEY",
+                "SecretAccessKey": "bench-secret-access-key",
+                "Token": "bench-session-token",
+                "Expiration": expiration,
+            }), "application/json")
+        elif self.path == "/latest/meta-data/placement/region":
+            self.server_fake.count("region")
+            self.reply(200, "us-east-1")
+        else:
+            self.reply(404, "")
+
+
+class FakeImds(FakeServer):
+    """IMDSv2: token, role name, role credentials and region"""
+    handler = _ImdsHandler
+
+
+class _AwsJsonHandler(_QuietHandler):
+    """The awsJson protocol used by SecretsManager and CloudWatch Logs: POST / with X-Amz-Target"""
+
+    def do_POST(self):
+        target = self.headers.get("X-Amz-Target", "")
+        operation = target.rsplit(".", 1)[-1]
+        body = json.loads(self.read_body() or b"{}")
+        self.server_fake.count(operation)
+        method = getattr(self.server_fake, f"op_{operation}", None)
+        if method is None:
+            self.reply(400, json.dumps({"__type": "UnknownOperationException"}), "application/x-amz-json-1.1")
+            return
+        self.reply(200, json.dumps(method(body)), "application/x-amz-json-1.1")
+
+
+class FakeSecretsManager(FakeServer):
+    handler = _AwsJsonHandler
+
+    def __init__(self, secret_size=256):
+        super().__init__()
+        self.secret_size = secret_size
+
+    def secret(self, secret_id):
+        return {
+            "ARN": f"arn:aws:secretsmanager:us-east-1:000000000000:secret:{secret_id}",
+            "Name": secret_id,
+            "VersionId": "bench-version",
+            "SecretString": (secret_id + ":") * (self.secret_size // (len(secret_id) + 1) + 1),
+            "CreatedDate": time.time(),
+        }
+
+    def op_GetSecretValue(self, body):
+        return self.secret(body["SecretId"])
+
+    def op_BatchGetSecretValue(self, body):
+        return {"SecretValues": [self.secret(secret_id) for secret_id in body.get("SecretIdList", [])], "Errors": []}
+
+
+class FakeCloudWatchLogs(FakeServer):
+    handler = _AwsJsonHandler
+
+    def __init__(self):
+        super().__init__()
+        self.events = 0
+        self.bytes = 0
+        self.last_event_at = None
+        self.received = threading.Condition()
+
+    def op_CreateLogGroup(self, body):
+        return {}
+
+    def op_CreateLogStream(self, body):
+        return {}
+
+    def op_PutLogEvents(self, body):
+        events = body.get("logEvents", [])
+        with self.received:
+            self.events += len(events)
+            self.bytes += sum(len(event["message"].encode()) for event in events)
+            self.last_event_at = time.monotonic()
+            self.received.notify_all()
+        return {"nextSequenceToken": "bench"}
+
+    def wait_for_bytes(self, total, timeout):
+        with self.received:
+            return self.received.wait_for(lambda: self.bytes >= total, timeout)
+
+
+class EnclaveStandin:
+    """The enclave end of a VSOCK port, listening through a stand-in socket module.
+
+    mode "echo" echoes every byte back until the peer half-closes; mode
+    "json" reads one request and answers it with a small JSON document.
+    """
+
+    def __init__(self, socket_module, port, mode="echo", response_size=64):
+        self.sock = socket_module.socket(socket_module.AF_VSOCK, socket_module.SOCK_STREAM)
+        self.sock.bind((socket_module.VMADDR_CID_ANY, port))
+        self.sock.listen(1024)
+        self.mode = mode
+        self.response = json.dumps({"response_type": "bench", "response_value": "x" * response_size}).encode()
+        self.thread = threading.Thread(target=self._accept, daemon=True)
+
+    def _accept(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                return
+            threading.Thread(target=self._serve, args=(conn,), daemon=True).start()
+
+    def _serve(self, conn):
+        try:
+            if self.mode == "echo":
+                buffer = bytearray(256 * 1024)
+                while True:
+                    received = conn.recv_into(buffer)
+                    if not received:
+                        break
+                    conn.sendall(memoryview(buffer)[:received])
+            else:
+                conn.recv(65536)
+                conn.sendall(self.response)
+            conn.shutdown(socket.SHUT_WR)
+        except OSError:
+            pass
+        finally:
+            conn.close()
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.sock.close()
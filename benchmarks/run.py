@@ -0,0 +1,465 @@
+"""Reproducible benchmarks for the forwarder, the VSOCK helper and the two sidecars.
+
+Every component runs against local stand-ins: AF_VSOCK is replaced by AF_UNIX
+or loopback TCP (see standin.py), and IMDS, SecretsManager and CloudWatch Logs
+by the fakes in fakes.py. Results are printed as a table and can be written
+as JSON and compared against a previous run:
+
+    python benchmarks/run.py --output bench.json
+    python benchmarks/run.py --baseline bench.json --tolerance 0.15
+"""
+import argparse
+import contextlib
+import datetime
+import importlib.util
+import io
+import json
+import os
+import platform
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, REPO_DIR)
+
+import standin  # noqa: E402
+from fakes import EnclaveStandin, FakeCloudWatchLogs, FakeImds, FakeSecretsManager  # noqa: E402
+
+SCENARIOS = ("forwarder", "vsock_helper", "credential_requester", "cloudwatch_logger")
+
+
+class Skipped(Exception):
+    pass
+
+
+def percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+
+def latency_summary(latencies, elapsed):
+    return {
+        "requests": len(latencies),
+        "requests_per_s": len(latencies) / elapsed,
+        "p50_ms": percentile(latencies, 0.50) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        "mean_ms": statistics.mean(latencies) * 1000,
+    }
+
+
+def wait_until(check, timeout=15.0, what="service"):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if check():
+                return
+        except OSError:
+            pass
+        time.sleep(0.05)
+    raise RuntimeError(f"{what} did not become ready within {timeout}s")
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def require(*modules):
+    missing = [name for name in modules if importlib.util.find_spec(name) is None]
+    if missing:
+        raise Skipped(f"missing dependencies: {', '.join(missing)}")
+
+
+class Bench:
+    def __init__(self, args):
+        self.args = args
+        self.workdir = tempfile.mkdtemp(prefix="nitro-bench-")
+        self.vsock = standin.make_socket_module(args.transport, self.workdir)
+        self.next_vsock_port = 15000
+
+    def vsock_port(self):
+        if self.args.transport == "tcp":
+            return free_port()
+        self.next_vsock_port += 1
+        return self.next_vsock_port
+
+    @contextlib.contextmanager
+    def component(self, script, *script_args, env=None):
+        """Run a toolkit script in its own process under the VSOCK stand-in"""
+        command = [sys.executable, os.path.join(BENCH_DIR, "standin.py"),
+                   "--transport", self.args.transport, "--dir", self.workdir,
+                   os.path.join(REPO_DIR, script)] + [str(arg) for arg in script_args]
+        log = open(os.path.join(self.workdir, os.path.basename(script) + ".log"), "ab")
+        # The shared modules sit at the repository root, next to none of the sidecar scripts
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [REPO_DIR, os.environ.get("PYTHONPATH")])),
+                   **(env or {}))
+        process = subprocess.Popen(command, stdout=log, stderr=log, env=env)
+        try:
+            yield process
+        finally:
+            process.terminate()
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
+            log.close()
+
+    def vsock_connect(self, port, timeout=30):
+        sock = self.vsock.socket(self.vsock.AF_VSOCK, self.vsock.SOCK_STREAM)
+        sock.settimeout(timeout)
+        try:
+            sock.connect((3, port))
+        except OSError:
+            sock.close()
+            raise
+        return sock
+
+    def vsock_ready(self, port):
+        self.vsock_connect(port, timeout=1).close()
+        return True
+
+    # -- traffic_forwarder -------------------------------------------------
+
+    def forwarder(self):
+        results = {}
+        for engine, strategy in self.args.forwarder_variants:
+            results[f"forwarder[{engine},{strategy}]"] = self.forwarder_variant(engine, strategy)
+        return results
+
+    def forwarder_variant(self, engine, strategy):
+        vsock_port = self.vsock_port()
+        local_port = free_port()
+        with EnclaveStandin(self.vsock, vsock_port, mode="echo"), \
+                self.component("traffic_forwarder.py", "127.0.0.1", local_port, 3, vsock_port,
+                               "--engine", engine, "--copy-strategy", strategy,
+                               *self.args.forwarder_args):
+            wait_until(lambda: socket.create_connection(("127.0.0.1", local_port), timeout=1).close() or True,
+                       what="traffic_forwarder")
+            result = self.forwarder_throughput(local_port)
+            result.update(self.forwarder_connection_rate(local_port))
+        return result
+
+    def forwarder_throughput(self, port):
+        streams, size = self.args.streams, self.args.stream_mb * 1024 * 1024
+        payload = os.urandom(1024 * 1024)
+        failures = []
+
+        def stream():
+            try:
+                with socket.create_connection(("127.0.0.1", port)) as sock:
+                    def send():
+                        view = memoryview(payload)
+                        remaining = size
+                        while remaining:
+                            chunk = min(remaining, len(payload))
+                            sock.sendall(view[:chunk])
+                            remaining -= chunk
+                        sock.shutdown(socket.SHUT_WR)
+                    sender = threading.Thread(target=send)
+                    sender.start()
+                    buffer = bytearray(256 * 1024)
+                    received = 0
+                    while True:
+                        count = sock.recv_into(buffer)
+                        if not count:
+                            break
+                        received += count
+                    sender.join()
+                    if received != size:
+                        failures.append(received)
+            except OSError as e:
+                failures.append(e)
+
+        threads = [threading.Thread(target=stream) for _ in range(streams)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+        return {
+            "throughput_mb_s": 2 * streams * size / elapsed / 1e6,
+            "stream_failures": len(failures),
+        }
+
+    def forwarder_connection_rate(self, port):
+        latencies, failures = [], []
+        lock = threading.Lock()
+        deadline = time.monotonic() + self.args.duration
+
+        def client():
+            while time.monotonic() < deadline:
+                start = time.perf_counter()
+                try:
+                    with socket.create_connection(("127.0.0.1", port)) as sock:
+                        sock.sendall(b"x" * 64)
+                        sock.shutdown(socket.SHUT_WR)
+                        while sock.recv(4096):
+                            pass
+                except OSError as e:
+                    with lock:
+                        failures.append(e)
+                    continue
+                with lock:
+                    latencies.append(time.perf_counter() - start)
+
+        threads = [threading.Thread(target=client) for _ in range(self.args.concurrency)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+        summary = latency_summary(latencies, elapsed)
+        return {
+            "connections_per_s": summary["requests_per_s"],
+            "connect_p50_ms": summary["p50_ms"],
+            "connect_p99_ms": summary["p99_ms"],
+            "connection_failures": len(failures),
+        }
+
+    # -- vsock_helper ------------------------------------------------------
+
+    def vsock_helper(self):
+        import vsock_helper
+        vsock_helper.socket = self.vsock
+        vsock_port = self.vsock_port()
+        request = json.dumps({"request_type": "credentials", "key_name": None})
+        latencies = []
+        with EnclaveStandin(self.vsock, vsock_port, mode="json"), contextlib.redirect_stderr(io.StringIO()):
+            start = time.perf_counter()
+            for _ in range(self.args.requests):
+                began = time.perf_counter()
+                vsock_helper.vsock_request(3, vsock_port, request, retry_delay=0)
+                latencies.append(time.perf_counter() - began)
+            elapsed = time.perf_counter() - start
+        return {"vsock_helper": latency_summary(latencies, elapsed)}
+
+    # -- credential_requester ----------------------------------------------
+
+    def credential_requester(self):
+        require("requests", "boto3")
+        vsock_port = self.vsock_port()
+        results = {}
+        with FakeImds() as imds, FakeSecretsManager() as secrets, \
+                self.component("credential_requester/credential_requester.py", "--port", vsock_port, env={
+                    "AWS_EC2_METADATA_SERVICE_ENDPOINT": imds.url,
+                    "AWS_ENDPOINT_URL_SECRETS_MANAGER": secrets.url,
+                }):
+            wait_until(lambda: self.vsock_ready(vsock_port), what="credential_requester")
+            for name, request, fake in (
+                ("credentials", {"request_type": "credentials", "key_name": None}, imds),
+                ("SecretsManager", {"request_type": "SecretsManager", "key_name": "bench/secret"}, secrets),
+                ("SecretsManagerBatch", {"request_type": "SecretsManagerBatch",
+                                         "key_names": [f"bench/secret-{i}" for i in range(10)]}, secrets),
+            ):
+                imds.reset()
+                secrets.reset()
+                result = self.request_load(vsock_port, request)
+                result["imds_calls_per_request"] = sum(imds.calls.values()) / result["requests"]
+                result["secretsmanager_calls_per_request"] = sum(secrets.calls.values()) / result["requests"]
+                results[f"credential_requester[{name}]"] = result
+        return results
+
+    def request_load(self, port, request):
+        payload = json.dumps(request).encode()
+        latencies, errors = [], []
+        lock = threading.Lock()
+        per_client = max(1, self.args.requests // self.args.concurrency)
+
+        def client():
+            for _ in range(per_client):
+                began = time.perf_counter()
+                try:
+                    with self.vsock_connect(port) as sock:
+                        sock.sendall(payload)
+                        response = b""
+                        while True:
+                            chunk = sock.recv(65536)
+                            if not chunk:
+                                break
+                            response += chunk
+                    if json.loads(response).get("response_type") == "error":
+                        raise ValueError(response)
+                except (OSError, ValueError) as e:
+                    with lock:
+                        errors.append(e)
+                    continue
+                with lock:
+                    latencies.append(time.perf_counter() - began)
+
+        threads = [threading.Thread(target=client) for _ in range(self.args.concurrency)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+        if not latencies:
+            raise RuntimeError(f"every request failed, first error: {errors[0]}")
+        result = latency_summary(latencies, elapsed)
+        result["errors"] = len(errors)
+        return result
+
+    # -- cloudwatch_logger -------------------------------------------------
+
+    def cloudwatch_logger(self):
+        require("boto3")
+        vsock_port = self.vsock_port()
+        connections, size = self.args.concurrency, self.args.log_mb * 1024 * 1024 // self.args.concurrency
+        line = ("bench log line " + "x" * 84 + "\n").encode()
+        payload = line * (size // len(line))
+        with FakeCloudWatchLogs() as logs, \
+                self.component("logging/cloudwatch_logger.py", env={
+                    "VSOCK_PORT": str(vsock_port),
+                    "LOG_GROUP": "/bench/enclave",
+                    "LOG_STREAM": "bench",
+                    "AWS_REGION": "us-east-1",
+                    "AWS_ENDPOINT_URL_CLOUDWATCH_LOGS": logs.url,
+                    "AWS_ACCESS_KEY_ID": "bench",
+                    "AWS_SECRET_ACCESS_KEY": "bench",
+                }):
+            wait_until(lambda: self.vsock_ready(vsock_port), what="cloudwatch_logger")
+            logs.reset()
+
+            def sender():
+                with self.vsock_connect(vsock_port) as sock:
+                    sock.sendall(payload)
+
+            threads = [threading.Thread(target=sender) for _ in range(connections)]
+            start = time.perf_counter()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            sent_at = time.perf_counter()
+            # Lines are delivered as one event each, without the newline
+            expected = (len(payload) - payload.count(b"\n")) * connections
+            delivered = logs.wait_for_bytes(expected, timeout=self.args.drain_timeout)
+            elapsed = time.perf_counter() - start
+            calls = logs.calls["PutLogEvents"]
+        return {"cloudwatch_logger": {
+            "ingest_mb_s": logs.bytes / elapsed / 1e6,
+            "send_mb_s": len(payload) * connections / (sent_at - start) / 1e6,
+            "delivered_fraction": logs.bytes / expected,
+            "put_log_events_calls": calls,
+            "events_per_call": logs.events / calls if calls else 0,
+            "complete": bool(delivered),
+        }}
+
+
+def compare(results, baseline, tolerance):
+    """Return a line for every metric that regressed by more than tolerance"""
+    regressions = []
+    for scenario, metrics in results.items():
+        for metric, value in metrics.items():
+            previous = baseline.get(scenario, {}).get(metric)
+            if not isinstance(previous, (int, float)) or isinstance(previous, bool) or not previous:
+                continue
+            if metric.endswith(("_mb_s", "_per_s")):
+                change = (previous - value) / previous
+            elif metric.endswith("_ms"):
+                change = (value - previous) / previous
+            else:
+                continue
+            if change > tolerance:
+                regressions.append(f"{scenario} {metric}: {previous:.3f} -> {value:.3f} ({change:+.0%} worse)")
+    return regressions
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=REPO_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--only", default=",".join(SCENARIOS),
+                        help=f"Comma-separated scenarios to run (default: {','.join(SCENARIOS)})")
+    parser.add_argument("--transport", choices=standin.TRANSPORTS, default="unix",
+                        help="Stand-in for AF_VSOCK (default: unix)")
+    parser.add_argument("--quick", action="store_true", help="Small sizes for a smoke run")
+    parser.add_argument("--variants", default="threads:recv,threads:recv_into,events:recv_into,events:splice",
+                        help="traffic_forwarder engine:copy_strategy pairs to compare")
+    parser.add_argument("--forwarder-args", default="",
+                        help="Extra traffic_forwarder options, e.g. '--log-summary-interval 60'")
+    parser.add_argument("--output", help="Write results as JSON to this file")
+    parser.add_argument("--baseline", help="Compare against a previous --output file")
+    parser.add_argument("--tolerance", type=float, default=0.15,
+                        help="Allowed relative regression before exiting non-zero (default: 0.15)")
+    args = parser.parse_args()
+
+    sizes = dict(streams=4, stream_mb=8, duration=2.0, concurrency=4, requests=40, log_mb=2, drain_timeout=30) \
+        if args.quick else \
+        dict(streams=16, stream_mb=64, duration=10.0, concurrency=16, requests=400, log_mb=32, drain_timeout=120)
+    for name, value in sizes.items():
+        setattr(args, name, value)
+    args.forwarder_variants = [tuple(variant.split(":")) for variant in args.variants.split(",") if variant]
+    args.forwarder_args = args.forwarder_args.split()
+    args.only = [name for name in args.only.split(",") if name]
+    unknown = set(args.only) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenario(s): {', '.join(sorted(unknown))}")
+    return args
+
+
+def main():
+    args = parse_args()
+    bench = Bench(args)
+    results, skipped = {}, {}
+    try:
+        for name in args.only:
+            print(f"Running {name}...", file=sys.stderr)
+            try:
+                results.update(getattr(bench, name)())
+            except Skipped as e:
+                skipped[name] = str(e)
+                print(f"  skipped: {e}", file=sys.stderr)
+    finally:
+        shutil.rmtree(bench.workdir, ignore_errors=True)
+
+    for scenario, metrics in results.items():
+        print(scenario)
+        for metric, value in metrics.items():
+            print(f"  {metric:<34} {value:.3f}" if isinstance(value, float) else f"  {metric:<34} {value}")
+
+    report = {
+        "meta": {
+            "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "transport": args.transport,
+            "quick": args.quick,
+        },
+        "results": results,
+        "skipped": skipped,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f)["results"], args.tolerance)
+        for line in regressions:
+            print(f"REGRESSION {line}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+"""Local stand-ins for AF_VSOCK so the toolkit can be exercised off a Nitro host.
+
+A stand-in ``socket`` module is identical to the real one except that
+sockets created with AF_VSOCK become AF_UNIX (or loopback TCP) sockets, and
+VSOCK addresses -- ``(cid, port)`` tuples of two ints -- are translated to a
+per-port socket file (or ``127.0.0.1:port``). The CID is ignored, so a
+service bound to ``(VMADDR_CID_ANY, port)`` is reachable as ``(3, port)``.
+
+Run a component under the stand-in:
+
+    python benchmarks/standin.py --transport unix --dir /tmp/vsock traffic_forwarder.py 127.0.0.1 8080 3 5000
+"""
+import argparse
+import os
+import runpy
+import socket as _socket
+import sys
+import types
+
+TRANSPORTS = ("unix", "tcp")
+
+
+def make_socket_module(transport="unix", directory="/tmp"):
+    standin_family = _socket.AF_UNIX if transport == "unix" else _socket.AF_INET
+
+    def translate(address):
+        if isinstance(address, tuple) and len(address) == 2 and all(isinstance(part, int) for part in address):
+            if transport == "unix":
+                return os.path.join(directory, f"vsock-{address[1]}.sock")
+            return ("127.0.0.1", address[1])
+        return address
+
+    class StandinSocket(_socket.socket):
+        def __init__(self, family=-1, type=-1, proto=-1, fileno=None):
+            if family == _socket.AF_VSOCK:
+                family = standin_family
+                proto = 0
+            super().__init__(family, type, proto, fileno)
+
+        def bind(self, address):
+            address = translate(address)
+            if self.family == _socket.AF_UNIX and isinstance(address, str) and os.path.exists(address):
+                os.unlink(address)
+            elif self.family == _socket.AF_INET and transport == "tcp":
+                self.setsockopt(_socket.SOL_SOCKET, _socket.SO_REUSEADDR, 1)
+            return super().bind(address)
+
+        def connect(self, address):
+            return super().connect(translate(address))
+
+        def connect_ex(self, address):
+            return super().connect_ex(translate(address))
+
+    module = types.ModuleType("socket", _socket.__doc__)
+    module.__dict__.update({name: value for name, value in vars(_socket).items() if not name.startswith("__")})
+    module.socket = module.SocketType = StandinSocket
+    module.standin_address = translate
+    return module
+
+
+def install(transport="unix", directory="/tmp"):
+    """Replace the socket module for everything imported from now on"""
+    module = make_socket_module(transport, directory)
+    sys.modules["socket"] = module
+    return module
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a toolkit script with AF_VSOCK replaced by a local stand-in")
+    parser.add_argument("--transport", choices=TRANSPORTS, default="unix")
+    parser.add_argument("--dir", default="/tmp", help="Directory for AF_UNIX socket files")
+    parser.add_argument("script")
+    parser.add_argument("args", nargs=argparse.REMAINDER)
+    args = parser.parse_args()
+
+    install(args.transport, args.dir)
+    sys.argv = [args.script] + args.args
+    sys.path.insert(0, os.path.dirname(os.path.abspath(args.script)))
+    runpy.run_path(args.script, run_name="__main__")
+
+
+if __name__ == "__main__":
+    main()
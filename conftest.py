@@ -0,0 +1,2 @@
+# The services import the shared modules at the repository root (service_metrics,
+# instrumentation); conftest.py being here puts that directory on sys.path for tests
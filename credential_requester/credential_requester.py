@@ -1,182 +1,770 @@
 import socket
+import os
 import requests
 import json
 import logging
 import threading
 import argparse
+import calendar
+import time
+import collections
+import struct
+from concurrent.futures import ThreadPoolExecutor
 import boto3
-from botocore.exceptions import ClientError
+from botocore.exceptions import ClientError, BotoCoreError
 
-# IMDSv2 endpoint
-IMDS_URL = "http://169.254.169.254/latest/meta-data/iam/security-credentials/"
+try:
+    from instrumentation import setup as setup_instrumentation, timed
+except ImportError:  # Profiling hooks are optional, see instrumentation.py
+    def setup_instrumentation(service):
+        return None
+
+    def timed(name):
+        return lambda func: func
+
+# IMDSv2 endpoint, overridable the same way as in the AWS SDKs
+IMDS_ENDPOINT = os.environ.get("AWS_EC2_METADATA_SERVICE_ENDPOINT", "http://169.254.169.254").rstrip("/")
+IMDS_URL = f"{IMDS_ENDPOINT}/latest/meta-data/iam/security-credentials/"
+IMDS_TOKEN_TTL = 21600
+# Seconds to wait for IMDS to connect or answer
+IMDS_TIMEOUT = 2
+# Used when the role credentials come without an Expiration timestamp
+DEFAULT_CREDENTIALS_TTL = 900
+# BatchGetSecretValue accepts at most 20 secret ids per call
+MAX_BATCH_SECRETS = 20
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Keep-alive connection to IMDS shared by every lookup
+imds_session = requests.Session()
+imds_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="imds")
+
 class EnclaveRequest:
-    def __init__(self, request_type, key_name=None):
+    def __init__(self, request_type, key_name=None, key_names=None):
         self.request_type = request_type
         self.key_name = key_name
+        self.key_names = key_names
 
 class ParentResponse:
     def __init__(self, response_type, response_value):
         self.response_type = response_type
         self.response_value = response_value
 
+@timed("imds_token")
 def get_imdsv2_token():
     headers = {"X-aws-ec2-metadata-token-ttl-seconds": "21600"}
     try:
-        response = requests.put("http://169.254.169.254/latest/api/token", headers=headers)
+        response = imds_session.put(f"{IMDS_ENDPOINT}/latest/api/token", headers=headers, timeout=IMDS_TIMEOUT)
         response.raise_for_status()
         return response.text
     except requests.RequestException as e:
         logger.error(f"Failed to get IMDSv2 token: {e}")
         return None
 
+@timed("imds_role_name")
+def get_role_name(token):
+    headers = {"X-aws-ec2-metadata-token": token}
+    try:
+        response = imds_session.get(IMDS_URL, headers=headers, timeout=IMDS_TIMEOUT)
+        response.raise_for_status()
+        return response.text
+    except requests.RequestException as e:
+        logger.error(f"Failed to get IAM role name: {e}")
+        return None
+
+@timed("imds_credentials")
 def get_credentials(role_name, token):
     headers = {"X-aws-ec2-metadata-token": token}
     try:
-        response = requests.get(f"{IMDS_URL}{role_name}", headers=headers)
+        response = imds_session.get(f"{IMDS_URL}{role_name}", headers=headers, timeout=IMDS_TIMEOUT)
         response.raise_for_status()
         return json.loads(response.text)
     except (requests.RequestException, json.JSONDecodeError) as e:
         logger.error(f"Failed to get credentials: {e}")
         return None
 
+class ClientCache:
+    """SecretsManager clients keyed by credentials and region.
+
+    Clients are rebuilt only when the credentials rotate; clients for the
+    previous credentials are dropped at that point.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.access_key = None
+        self.clients = {}
+
+    def get(self, region_name, aws_access_key_id, aws_secret_access_key, aws_session_token):
+        with self.lock:
+            access_key = (aws_access_key_id, aws_session_token)
+            if access_key != self.access_key:
+                self.access_key = access_key
+                self.clients = {}
+            client = self.clients.get(region_name)
+            if client is None:
+                session = boto3.session.Session(
+                    aws_access_key_id=aws_access_key_id,
+                    aws_secret_access_key=aws_secret_access_key,
+                    aws_session_token=aws_session_token
+                )
+                client = session.client(
+                    service_name='secretsmanager',
+                    region_name=region_name
+                )
+                self.clients[region_name] = client
+            return client
+
+client_cache = ClientCache()
+
+class SecretCache:
+    """Bounded in-memory secret cache with a per-secret TTL and LRU eviction.
+
+    Disabled when max_entries is 0. Values are never written to disk.
+    """
+    def __init__(self, max_entries=0, ttl=300):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+        self.counters = {"hits": 0, "misses": 0, "evictions": 0}
+
+    def get(self, name):
+        if not self.max_entries:
+            return None
+        with self.lock:
+            entry = self.entries.get(name)
+            if entry is None or entry[1] <= time.monotonic():
+                if entry is not None:
+                    del self.entries[name]
+                self.counters["misses"] += 1
+                return None
+            self.entries.move_to_end(name)
+            self.counters["hits"] += 1
+            return entry[0]
+
+    def put(self, name, value):
+        if not self.max_entries:
+            return
+        with self.lock:
+            self.entries[name] = (value, time.monotonic() + self.ttl)
+            self.entries.move_to_end(name)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.counters["evictions"] += 1
+
+    def invalidate(self, name=None):
+        """Drop one secret, or every secret when name is None; returns the number dropped"""
+        with self.lock:
+            if name is None:
+                dropped = len(self.entries)
+                self.entries.clear()
+                return dropped
+            return 1 if self.entries.pop(name, None) is not None else 0
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats["entries"] = len(self.entries)
+        return stats
+
+secret_cache = SecretCache()
+
+@timed("secretsmanager_get_secret_value")
 def get_secret(secret_name, region_name, aws_access_key_id, aws_secret_access_key, aws_session_token):
-    session = boto3.session.Session(
-        aws_access_key_id=aws_access_key_id,
-        aws_secret_access_key=aws_secret_access_key,
-        aws_session_token=aws_session_token
-    )
-    client = session.client(
-        service_name='secretsmanager',
-        region_name=region_name
-    )
+    client = client_cache.get(region_name, aws_access_key_id, aws_secret_access_key, aws_session_token)
 
     try:
         get_secret_value_response = client.get_secret_value(SecretId=secret_name)
         return get_secret_value_response['SecretString']
-    except ClientError as e:
+    except (ClientError, BotoCoreError) as e:
         logger.error(f"Failed to get secret: {e}")
         return None
 
+def get_secrets_individually(secret_names, region_name, aws_access_key_id, aws_secret_access_key, aws_session_token):
+    with ThreadPoolExecutor(max_workers=min(len(secret_names), 8)) as executor:
+        results = executor.map(
+            lambda name: get_secret(name, region_name, aws_access_key_id, aws_secret_access_key, aws_session_token),
+            secret_names
+        )
+        values = dict(zip(secret_names, results))
+    secrets = {name: value for name, value in values.items() if value}
+    errors = {name: "Failed to retrieve secret" for name, value in values.items() if not value}
+    return secrets, errors
+
+@timed("secretsmanager_get_secrets")
+def get_secrets(secret_names, region_name, aws_access_key_id, aws_secret_access_key, aws_session_token):
+    """Fetch several secrets, returning ({name: secret}, {name: error})"""
+    client = client_cache.get(region_name, aws_access_key_id, aws_secret_access_key, aws_session_token)
+    if not hasattr(client, "batch_get_secret_value"):
+        # botocore older than 1.34 has no BatchGetSecretValue
+        return get_secrets_individually(secret_names, region_name, aws_access_key_id, aws_secret_access_key,
+                                        aws_session_token)
+
+    secrets, errors = {}, {}
+    for start in range(0, len(secret_names), MAX_BATCH_SECRETS):
+        chunk = secret_names[start:start + MAX_BATCH_SECRETS]
+        try:
+            response = client.batch_get_secret_value(SecretIdList=chunk)
+        except ClientError as e:
+            # For example a role allowed GetSecretValue but not BatchGetSecretValue
+            logger.warning(f"BatchGetSecretValue failed, fetching secrets individually: {e}")
+            chunk_secrets, chunk_errors = get_secrets_individually(chunk, region_name, aws_access_key_id,
+                                                                   aws_secret_access_key, aws_session_token)
+            secrets.update(chunk_secrets)
+            errors.update(chunk_errors)
+            continue
+        except BotoCoreError as e:
+            # SecretsManager unreachable; fetching one by one would fail the same way
+            logger.error(f"BatchGetSecretValue failed: {e}")
+            errors.update({name: "Failed to retrieve secret" for name in chunk})
+            continue
+
+        # Secrets may have been requested by name or by ARN
+        for value in response.get("SecretValues", []):
+            name = value.get("Name") if value.get("Name") in chunk else value.get("ARN")
+            if "SecretString" in value:
+                secrets[name] = value["SecretString"]
+            else:
+                errors[name] = "Secret has no SecretString"
+        for error in response.get("Errors", []):
+            logger.error(f"Failed to get secret {error.get('SecretId')}: {error.get('ErrorCode')}")
+            errors[error.get("SecretId")] = error.get("Message") or error.get("ErrorCode") or "Failed to retrieve secret"
+        for name in chunk:
+            if name not in secrets and name not in errors:
+                errors[name] = "Failed to retrieve secret"
+    return secrets, errors
+
+@timed("imds_region")
 def get_region(token):
     headers = {"X-aws-ec2-metadata-token": token}
     try:
-        response = requests.get("http://169.254.169.254/latest/meta-data/placement/region", headers=headers)
+        response = imds_session.get(f"{IMDS_ENDPOINT}/latest/meta-data/placement/region", headers=headers,
+                                    timeout=IMDS_TIMEOUT)
         response.raise_for_status()
         return response.text
     except requests.RequestException as e:
         logger.error(f"Failed to get region: {e}")
         return None
 
-def handle_client(conn, addr):
+def parse_expiration(creds):
     try:
-        # Read request from client
-        request_data = conn.recv(1024).decode()
-        request = json.loads(request_data, object_hook=lambda d: EnclaveRequest(**d))
+        return calendar.timegm(time.strptime(creds["Expiration"], "%Y-%m-%dT%H:%M:%SZ"))
+    except (KeyError, TypeError, ValueError):
+        return time.time() + DEFAULT_CREDENTIALS_TTL
 
-        if request.request_type == "credentials":
-            # Get IMDSv2 token
-            token = get_imdsv2_token()
-            if not token:
-                response = ParentResponse("error", "Failed to get IMDSv2 token")
-                conn.send(json.dumps(response.__dict__).encode())
-                return
+class CredentialError(Exception):
+    pass
 
-            # Get IAM role name
-            headers = {"X-aws-ec2-metadata-token": token}
-            try:
-                role_name = requests.get(IMDS_URL, headers=headers).text
-            except requests.RequestException as e:
-                logger.error(f"Failed to get IAM role name: {e}")
-                response = ParentResponse("error", "Failed to get IAM role name")
-                conn.send(json.dumps(response.__dict__).encode())
-                return
+class CredentialCache:
+    """Caches the IMDSv2 token, IAM role name, region and role credentials.
+
+    Concurrent misses wait for a single IMDS fetch and share its result, even
+    when it fails, and a background thread refreshes the credentials
+    refresh_margin seconds before they expire, so requests are normally
+    served without touching IMDS at all.
+    """
+    def __init__(self, refresh_margin=300, min_validity=60):
+        self.refresh_margin = refresh_margin
+        self.min_validity = min_validity
+        self.lock = threading.Lock()
+        self.fetch_lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.token = None
+        self.token_expires = 0
+        self.role_name = None
+        self.region = None
+        self.credentials = None
+        self.credentials_expires = 0
+        # Last fetch failure, handed to requests that waited on that fetch
+        self.last_error = None
+        self.last_error_at = 0
+        self.counters = {"hits": 0, "misses": 0, "coalesced": 0, "refreshes": 0, "errors": 0}
+
+    def _usable(self):
+        return self.credentials is not None and time.time() < self.credentials_expires - self.min_validity
+
+    def get(self):
+        """Return (credentials, region), raising CredentialError if IMDS fails"""
+        with self.lock:
+            if self._usable():
+                self.counters["hits"] += 1
+                return self.credentials, self.region
+        waiting_since = time.monotonic()
+        with self.fetch_lock:
+            with self.lock:
+                # Another thread may have fetched while this one waited
+                if self._usable():
+                    self.counters["coalesced"] += 1
+                    return self.credentials, self.region
+                if self.last_error is not None and self.last_error_at >= waiting_since:
+                    # That fetch failed; retrying straight away would fail the same way
+                    self.counters["coalesced"] += 1
+                    raise CredentialError(self.last_error)
+                self.counters["misses"] += 1
+            return self._refresh()
+
+    def _refresh(self):
+        """Fetch from IMDS; the caller holds fetch_lock"""
+        try:
+            now = time.time()
+            if self.token is None or now >= self.token_expires:
+                token = get_imdsv2_token()
+                if not token:
+                    raise CredentialError("Failed to get IMDSv2 token")
+                self.token = token
+                self.token_expires = now + IMDS_TOKEN_TTL - self.refresh_margin
 
-            # Get credentials
-            creds = get_credentials(role_name, token)
+            # The region does not depend on the role, so look it up alongside it
+            region_lookup = None if self.region else imds_executor.submit(get_region, self.token)
+
+            if self.role_name is None:
+                role_name = get_role_name(self.token)
+                if not role_name:
+                    raise CredentialError("Failed to get IAM role name")
+                self.role_name = role_name
+
+            creds = get_credentials(self.role_name, self.token)
             if not creds:
-                response = ParentResponse("error", "Failed to get credentials")
-                conn.send(json.dumps(response.__dict__).encode())
-                return
+                # The token may have been revoked or the role replaced; start over next time
+                self.token = None
+                self.role_name = None
+                raise CredentialError("Failed to get credentials")
 
-            # Get region
-            region = get_region(token)
+            region = self.region or region_lookup.result()
             if not region:
-                response = ParentResponse("error", "Failed to get region")
-                conn.send(json.dumps(response.__dict__).encode())
-                return
+                raise CredentialError("Failed to get region")
+        except CredentialError as e:
+            with self.lock:
+                self.counters["errors"] += 1
+                self.last_error = str(e)
+                self.last_error_at = time.monotonic()
+            raise
 
-            # Prepare response
-            response_value = {
-                "AccessKeyId": creds["AccessKeyId"],
-                "SecretAccessKey": creds["SecretAccessKey"],
-                "Token": creds["Token"],
-                "Region": region
-            }
-            response = ParentResponse("credentials", response_value)
-            conn.send(json.dumps(response.__dict__).encode())
-        elif request.request_type == "SecretsManager":
-            if not request.key_name:
-                response = ParentResponse("error", "Missing key_name for SecretsManager request")
-                conn.send(json.dumps(response.__dict__).encode())
-                return
+        with self.lock:
+            self.credentials = creds
+            self.credentials_expires = parse_expiration(creds)
+            self.region = region
+            self.last_error = None
+            self.counters["refreshes"] += 1
+        self.wakeup.set()
+        return creds, region
 
-            # Get AWS credentials first
-            token = get_imdsv2_token()
-            if not token:
-                response = ParentResponse("error", "Failed to get IMDSv2 token")
-                conn.send(json.dumps(response.__dict__).encode())
-                return
+    def start(self):
+        threading.Thread(target=self._refresh_loop, daemon=True).start()
 
-            headers = {"X-aws-ec2-metadata-token": token}
+    def _refresh_loop(self):
+        retry_delay = 1
+        while True:
+            self.wakeup.clear()
+            with self.lock:
+                due = self.credentials_expires - self.refresh_margin if self.credentials else None
+            delay = None if due is None else due - time.time()
+            if delay is None or delay > 0:
+                # Sleep until the refresh is due or a request fetched new credentials
+                self.wakeup.wait(delay)
+                continue
             try:
-                role_name = requests.get(IMDS_URL, headers=headers).text
-            except requests.RequestException as e:
-                logger.error(f"Failed to get IAM role name: {e}")
-                response = ParentResponse("error", "Failed to get IAM role name")
-                conn.send(json.dumps(response.__dict__).encode())
-                return
+                with self.fetch_lock:
+                    self._refresh()
+            except CredentialError as e:
+                logger.warning(f"Background credential refresh failed, retrying in {retry_delay}s: {e}")
+            else:
+                with self.lock:
+                    still_due = time.time() >= self.credentials_expires - self.refresh_margin
+                if not still_due:
+                    logger.info("Refreshed cached credentials ahead of expiry")
+                    retry_delay = 1
+                    continue
+                # IMDS has not rotated the credentials yet, or refresh_margin
+                # exceeds their lifetime; back off instead of refetching at once
+                logger.debug(f"Refreshed credentials still expire within the refresh margin, "
+                             f"retrying in {retry_delay}s")
+            time.sleep(retry_delay)
+            retry_delay = min(retry_delay * 2, 60)
 
-            creds = get_credentials(role_name, token)
-            if not creds:
-                response = ParentResponse("error", "Failed to get credentials")
-                conn.send(json.dumps(response.__dict__).encode())
-                return
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats["credentials_expire_in"] = round(self.credentials_expires - time.time()) if self.credentials else None
+        return stats
 
-            # Get region
-            region = get_region(token)
-            if not region:
-                response = ParentResponse("error", "Failed to get region")
-                conn.send(json.dumps(response.__dict__).encode())
-                return
+credential_cache = CredentialCache()
 
-            # Now use these credentials to get the secret
-            secret = get_secret(
-                request.key_name,
-                region,  # Use the dynamically fetched region
+class SecretPrefetcher:
+    """Fetches a configured list of secrets at startup and keeps them warm.
+
+    Prefetched secrets are pinned in memory independently of the secret cache
+    and refetched every interval seconds, or sooner after an invalidation.
+    The service reports ready once the first pass has finished.
+    """
+    def __init__(self, names=(), interval=300, ready_file=None):
+        self.names = list(names)
+        self.interval = interval
+        self.ready_file = ready_file
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.ready = threading.Event()
+        self.values = {}
+        self.failures = {}
+        self.warmup_seconds = None
+        self.refreshes = 0
+        self.rotations = 0
+
+    def get(self, name):
+        with self.lock:
+            return self.values.get(name)
+
+    def start(self):
+        if self.ready_file and os.path.exists(self.ready_file):
+            os.remove(self.ready_file)
+        if not self.names:
+            self._mark_ready()
+            return
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def _mark_ready(self):
+        self.ready.set()
+        if self.ready_file:
+            try:
+                with open(self.ready_file, "w") as f:
+                    f.write(f"{time.time()}\n")
+            except OSError as e:
+                logger.error(f"Could not write ready file {self.ready_file}: {e}")
+
+    def _fetch(self):
+        try:
+            creds, region = credential_cache.get()
+            secrets, errors = get_secrets(
+                self.names,
+                region,
                 creds["AccessKeyId"],
                 creds["SecretAccessKey"],
                 creds["Token"]
             )
+        except (CredentialError, ClientError, BotoCoreError) as e:
+            secrets, errors = {}, {name: str(e) for name in self.names}
+        except Exception as e:
+            # Anything else must not end the refresh loop either
+            logger.exception(f"Unexpected error prefetching secrets: {e}")
+            secrets, errors = {}, {name: "Failed to retrieve secret" for name in self.names}
 
-            if secret:
-                response = ParentResponse("secret", secret)
-            else:
-                response = ParentResponse("error", "Failed to retrieve secret")
+        with self.lock:
+            for name, secret in secrets.items():
+                if name in self.values and self.values[name] != secret:
+                    logger.info(f"Prefetched secret {name} was rotated")
+                    self.rotations += 1
+                self.values[name] = secret
+            # A failed refresh keeps serving the last good value
+            self.failures = errors
+            self.refreshes += 1
+        return errors
 
-            conn.send(json.dumps(response.__dict__).encode())
+    def _run(self):
+        start = time.monotonic()
+        errors = dict.fromkeys(self.names, "Failed to retrieve secret")
+        try:
+            errors = self._fetch()
+        finally:
+            # Ready means the first pass is over, whether or not it succeeded
+            self.warmup_seconds = time.monotonic() - start
+            self._mark_ready()
+        if errors:
+            logger.warning(f"Prefetched {len(self.names) - len(errors)}/{len(self.names)} secrets in "
+                           f"{self.warmup_seconds:.3f}s, failed: {', '.join(sorted(errors))}")
         else:
-            response = ParentResponse("error", "Unknown request type")
-            conn.send(json.dumps(response.__dict__).encode())
+            logger.info(f"Prefetched {len(self.names)} secrets in {self.warmup_seconds:.3f}s")
+
+        while True:
+            # Retry failures sooner than the regular refresh
+            delay = min(self.interval, 30) if errors else self.interval
+            self.wakeup.wait(delay)
+            self.wakeup.clear()
+            try:
+                errors = self._fetch()
+            except Exception as e:
+                logger.exception(f"Prefetch refresh failed: {e}")
+                continue
+            if errors:
+                logger.warning(f"Failed to refresh prefetched secrets: {', '.join(sorted(errors))}")
+
+    def invalidate(self, name=None):
+        """Drop one or all prefetched values and refetch them right away"""
+        with self.lock:
+            if name is None:
+                self.values.clear()
+            elif self.values.pop(name, None) is None:
+                return
+        self.wakeup.set()
+
+    def stats(self):
+        with self.lock:
+            return {
+                "ready": self.ready.is_set(),
+                "secrets": len(self.names),
+                "loaded": len(self.values),
+                "warmup_seconds": round(self.warmup_seconds, 3) if self.warmup_seconds is not None else None,
+                "failures": dict(self.failures),
+                "refreshes": self.refreshes,
+                "rotations": self.rotations,
+            }
+
+prefetcher = SecretPrefetcher()
+
+def cached_secret(name):
+    secret = prefetcher.get(name)
+    if secret is None:
+        secret = secret_cache.get(name)
+    return secret
+
+@timed("process_request")
+def process_request(request):
+    """Answer one EnclaveRequest with a ParentResponse"""
+    if request.request_type == "credentials":
+        try:
+            creds, region = credential_cache.get()
+        except CredentialError as e:
+            return ParentResponse("error", str(e))
+
+        # Prepare response
+        response_value = {
+            "AccessKeyId": creds["AccessKeyId"],
+            "SecretAccessKey": creds["SecretAccessKey"],
+            "Token": creds["Token"],
+            "Region": region
+        }
+        return ParentResponse("credentials", response_value)
+    elif request.request_type == "SecretsManager":
+        if not request.key_name:
+            return ParentResponse("error", "Missing key_name for SecretsManager request")
+
+        secret = cached_secret(request.key_name)
+        if secret is not None:
+            return ParentResponse("secret", secret)
+
+        # Get AWS credentials first
+        try:
+            creds, region = credential_cache.get()
+        except CredentialError as e:
+            return ParentResponse("error", str(e))
+
+        # Now use these credentials to get the secret
+        secret = get_secret(
+            request.key_name,
+            region,  # Use the dynamically fetched region
+            creds["AccessKeyId"],
+            creds["SecretAccessKey"],
+            creds["Token"]
+        )
+
+        if not secret:
+            return ParentResponse("error", "Failed to retrieve secret")
+        secret_cache.put(request.key_name, secret)
+        return ParentResponse("secret", secret)
+    elif request.request_type == "SecretsManagerBatch":
+        key_names = request.key_names
+        if not isinstance(key_names, list) or not key_names or not all(isinstance(name, str) and name for name in key_names):
+            return ParentResponse("error", "key_names must be a non-empty list of secret names")
+
+        secrets, errors = {}, {}
+        missing = []
+        for name in dict.fromkeys(key_names):
+            secret = cached_secret(name)
+            if secret is not None:
+                secrets[name] = secret
+            else:
+                missing.append(name)
+
+        if missing:
+            # Credentials are resolved once for the whole batch
+            try:
+                creds, region = credential_cache.get()
+            except CredentialError as e:
+                return ParentResponse("error", str(e))
+
+            fetched, errors = get_secrets(
+                missing,
+                region,
+                creds["AccessKeyId"],
+                creds["SecretAccessKey"],
+                creds["Token"]
+            )
+            for name, secret in fetched.items():
+                secret_cache.put(name, secret)
+            secrets.update(fetched)
+
+        return ParentResponse("secrets", {"secrets": secrets, "errors": errors})
+    elif request.request_type == "status":
+        return ParentResponse("status", {
+            "ready": prefetcher.ready.is_set(),
+            "credential_cache": credential_cache.stats(),
+            "secret_cache": secret_cache.stats(),
+            "prefetch": prefetcher.stats(),
+        })
+    elif request.request_type == "invalidate":
+        # key_name null drops every cached secret
+        prefetcher.invalidate(request.key_name)
+        return ParentResponse("invalidated", secret_cache.invalidate(request.key_name))
+    else:
+        return ParentResponse("error", "Unknown request type")
+
+# Framed protocol: the client opens with PROTOCOL_MAGIC and a version byte,
+# then sends any number of frames, each a 4-byte big-endian length followed by
+# a JSON request carrying an "id". Responses are framed the same way, echo the
+# id and may arrive in any order. A connection that starts with anything else
+# is treated as the original one-shot JSON exchange.
+PROTOCOL_MAGIC = b"NTF"
+PROTOCOL_VERSION = 1
+FRAME_HEADER = struct.Struct(">I")
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+MAX_IN_FLIGHT = 16
+# Seconds a connection may sit without sending anything before it is closed
+IDLE_TIMEOUT = 60
+
+def send_frame(conn, message):
+    payload = json.dumps(message).encode()
+    conn.sendall(FRAME_HEADER.pack(len(payload)) + payload)
+
+def incomplete_json(data):
+    """Whether data could still become a JSON object once more of it arrives"""
+    if not data.lstrip().startswith(b"{"):
+        return False
+    try:
+        text = data.decode()
+    except UnicodeDecodeError as e:
+        return e.reason == "unexpected end of data"
+    try:
+        json.loads(text)
+        return False
+    except json.JSONDecodeError as e:
+        # Cut off inside a string, a literal or a number, or right at the end
+        tail = text[e.pos:]
+        return (e.msg.startswith("Unterminated string") or
+                any(literal.startswith(tail) for literal in ("true", "false", "null")) or
+                not tail.lstrip("-+.0123456789eE"))
+
+def serve_legacy(conn, reader, pool):
+    """Read one JSON request, however many reads it spans, and answer it"""
+    request_data = b""
+    while True:
+        chunk = reader.read1(65536)
+        if not chunk:
+            if not request_data.strip():
+                return
+            break
+        request_data += chunk
+        if len(request_data) > MAX_FRAME_SIZE:
+            raise ValueError("Request too large")
+        if not incomplete_json(request_data):
+            break
+    try:
+        request = json.loads(request_data, object_hook=lambda d: EnclaveRequest(**d))
+    except (ValueError, TypeError):
+        # Answer at once rather than leave the client to time out and retry
+        conn.sendall(json.dumps(ParentResponse("error", "Malformed request").__dict__).encode())
+        return
+    response = pool.submit(process_request, request).result()
+    conn.sendall(json.dumps(response.__dict__).encode())
+
+class RequestPool:
+    """Worker pool that holds at most max_requests running or queued requests.
+
+    submit() blocks the calling connection's reader once that many are
+    outstanding, so a burst of pipelined requests cannot queue without bound.
+    """
+    def __init__(self, workers, max_requests):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="request")
+        self.slots = threading.BoundedSemaphore(max_requests)
+
+    def submit(self, func, *args):
+        self.slots.acquire()
+        try:
+            future = self.executor.submit(func, *args)
+        except Exception:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda _: self.slots.release())
+        return future
+
+def serve_framed(conn, reader, addr, pool):
+    """Answer framed requests concurrently until the client closes its side or goes idle"""
+    send_lock = threading.Lock()
+    in_flight = threading.BoundedSemaphore(MAX_IN_FLIGHT)
+
+    def reply(request_id, response):
+        with send_lock:
+            send_frame(conn, dict(response.__dict__, id=request_id))
+
+    def run(request_id, request):
+        try:
+            try:
+                response = process_request(request)
+            except Exception as e:
+                logger.error(f"Error answering request {request_id} from {addr}: {e}")
+                response = ParentResponse("error", "Internal error")
+            reply(request_id, response)
+        except OSError as e:
+            logger.error(f"Error sending response {request_id} to {addr}: {e}")
+        finally:
+            in_flight.release()
+
+    try:
+        while True:
+            try:
+                header = reader.read(FRAME_HEADER.size)
+            except socket.timeout:
+                logger.info(f"Closing idle connection from {addr}")
+                break
+            if len(header) < FRAME_HEADER.size:
+                break
+            (length,) = FRAME_HEADER.unpack(header)
+            if length > MAX_FRAME_SIZE:
+                reply(None, ParentResponse("error", "Request too large"))
+                break
+            body = reader.read(length)
+            if len(body) < length:
+                break
+
+            request_id = None
+            try:
+                message = json.loads(body)
+                request_id = message.pop("id", None)
+                request = EnclaveRequest(**message)
+            except (ValueError, TypeError, AttributeError):
+                reply(request_id, ParentResponse("error", "Malformed request"))
+                continue
+
+            in_flight.acquire()
+            pool.submit(run, request_id, request)
+    finally:
+        # Let outstanding requests finish before the connection is closed
+        for _ in range(MAX_IN_FLIGHT):
+            in_flight.acquire()
+
+def handle_client(conn, addr, pool):
+    # Stalled or idle clients would otherwise hold their thread and slot forever
+    conn.settimeout(IDLE_TIMEOUT)
+    reader = conn.makefile("rb")
+    try:
+        first = reader.peek(1)[:1]
+        if first == PROTOCOL_MAGIC[:1]:
+            preamble = reader.read(len(PROTOCOL_MAGIC) + 1)
+            if preamble[:-1] != PROTOCOL_MAGIC or preamble[-1] != PROTOCOL_VERSION:
+                logger.error(f"Unsupported protocol preamble {preamble!r} from {addr}")
+                send_frame(conn, dict(ParentResponse("error", "Unsupported protocol version").__dict__, id=None))
+                return
+            serve_framed(conn, reader, addr, pool)
+        elif first:
+            serve_legacy(conn, reader, pool)
+    except socket.timeout:
+        logger.warning(f"Timed out waiting for a request from {addr}")
     except Exception as e:
         logger.error(f"Error handling client {addr}: {e}")
     finally:
+        reader.close()
         conn.close()
 
-def main(port):
+def main(port, workers=16, max_connections=64, max_requests=256):
     # Create vsock socket
     s = socket.socket(socket.AF_VSOCK, socket.SOCK_STREAM)
 
@@ -187,12 +775,27 @@ def main(port):
         s.bind((cid, port))
         s.listen()
 
-        logger.info(f"Listening on port {port}")
+        logger.info(f"Listening on port {port} with {workers} workers and up to {max_connections} connections")
+        credential_cache.start()
+        prefetcher.start()
+
+        # Requests run on a fixed pool of workers and up to max_requests queue
+        # behind them; once max_connections are open, idle ones included,
+        # further clients wait in the listen backlog
+        pool = RequestPool(workers, max_requests)
+        connection_slots = threading.BoundedSemaphore(max_connections)
+
+        def run_client(conn, addr):
+            try:
+                handle_client(conn, addr, pool)
+            finally:
+                connection_slots.release()
 
         while True:
+            connection_slots.acquire()
             conn, addr = s.accept()
             logger.info(f"Connected by {addr}")
-            threading.Thread(target=handle_client, args=(conn, addr)).start()
+            threading.Thread(target=run_client, args=(conn, addr), daemon=True).start()
     except Exception as e:
         logger.error(f"Error in main loop: {e}")
     finally:
@@ -202,6 +805,41 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Credential requester for AWS IMDSv2")
     parser.add_argument("-p", "--port", type=int, default=5000,
                         help="Port number to listen on (default: 5000)")
+    parser.add_argument("--refresh-margin", type=int, default=300,
+                        help="Refresh cached credentials this many seconds before they expire (default: 300)")
+    parser.add_argument("--secret-cache-size", type=int, default=0,
+                        help="Keep up to this many secrets in memory (default: 0, disabled)")
+    parser.add_argument("--secret-cache-ttl", type=int, default=300,
+                        help="Seconds a cached secret is served before it is fetched again (default: 300)")
+    parser.add_argument("--workers", type=int, default=16,
+                        help="Requests processed concurrently; further requests queue (default: 16)")
+    parser.add_argument("--max-connections", type=int, default=64,
+                        help="Open enclave connections, idle ones included, before new ones wait to be "
+                             "accepted (default: 64)")
+    parser.add_argument("--max-requests", type=int, default=256,
+                        help="Requests running or queued for a worker before connections stop reading "
+                             "new ones (default: 256)")
+    parser.add_argument("--idle-timeout", type=float, default=60,
+                        help="Close connections that send nothing for this many seconds (default: 60)")
+    parser.add_argument("--imds-timeout", type=float, default=2,
+                        help="Seconds to wait for each IMDS call (default: 2)")
+    parser.add_argument("--prefetch-secrets", default=os.environ.get("PREFETCH_SECRETS", ""),
+                        help="Comma-separated secrets to fetch at startup and keep warm "
+                             "(default: $PREFETCH_SECRETS)")
+    parser.add_argument("--prefetch-interval", type=int, default=300,
+                        help="Seconds between refreshes of the prefetched secrets (default: 300)")
+    parser.add_argument("--ready-file",
+                        help="File created once the startup prefetch has finished, for health checks")
     args = parser.parse_args()
 
-    main(args.port)
+    IMDS_TIMEOUT = args.imds_timeout
+    IDLE_TIMEOUT = args.idle_timeout
+    credential_cache.refresh_margin = args.refresh_margin
+    secret_cache.max_entries = args.secret_cache_size
+    secret_cache.ttl = args.secret_cache_ttl
+    prefetcher.names = [name.strip() for name in args.prefetch_secrets.split(",") if name.strip()]
+    prefetcher.interval = args.prefetch_interval
+    prefetcher.ready_file = args.ready_file
+
+    setup_instrumentation("credential_requester")
+    main(args.port, args.workers, args.max_connections, args.max_requests)
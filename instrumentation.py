@@ -0,0 +1,365 @@
+"""Opt-in profiling and hot-path timing shared by the toolkit's services.
+
+Nothing happens unless INSTRUMENT_DIR is set: span() then returns a shared
+no-op context manager and timed() hands functions back unwrapped, so the
+hooks in the services cost nothing. With INSTRUMENT_DIR set, setup() makes
+a running service answer
+
+    SIGUSR1   start the profiler, or stop it and write its dump
+    SIGUSR2   start tracemalloc, or write a snapshot (with the growth since
+              the previous one) if it is already tracing
+
+and the same commands on a control socket, INSTRUMENT_DIR/<service>-<pid>.sock:
+
+    echo profile | nc -U /tmp/instrument/credential_requester-42.sock
+
+Commands are profile, tracemalloc, tracemalloc-stop, spans and status; each
+answers with one line of JSON. Every dump also writes the timing spans
+(calls, total, mean and max per span) gathered so far. Signals and commands
+are only queued; the instrumentation-worker thread carries them out, so a
+signal handler never takes a lock or writes a file on the main thread.
+
+The profiler is chosen by INSTRUMENT_PROFILER. "sampling" (the default)
+records the stacks of all threads every INSTRUMENT_SAMPLE_INTERVAL seconds
+into a folded-stacks file for flamegraph.pl or speedscope; "cprofile"
+profiles the main thread deterministically into a .pstats file, which suits
+the forwarder's events engine. INSTRUMENT_START=profile,tracemalloc starts
+either right away, and dumps are written at exit, which is how to profile a
+short-lived process such as vsock_helper.py.
+"""
+import atexit
+import collections
+import cProfile
+import functools
+import itertools
+import json
+import logging
+import os
+import queue
+import signal
+import socket
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import closing, nullcontext
+
+INSTRUMENT_DIR = os.environ.get("INSTRUMENT_DIR", "")
+PROFILER = os.environ.get("INSTRUMENT_PROFILER", "sampling")
+SAMPLE_INTERVAL = float(os.environ.get("INSTRUMENT_SAMPLE_INTERVAL", "0.005"))
+TRACEMALLOC_FRAMES = int(os.environ.get("INSTRUMENT_TRACEMALLOC_FRAMES", "10"))
+START = [name for name in os.environ.get("INSTRUMENT_START", "").split(",") if name]
+
+enabled = bool(INSTRUMENT_DIR)
+
+logger = logging.getLogger("instrumentation")
+
+NULL_SPAN = nullcontext()
+spans = {}  # name -> [calls, total seconds, max seconds]
+spans_lock = threading.Lock()
+
+def record(name, seconds):
+    with spans_lock:
+        stats = spans.get(name)
+        if stats is None:
+            spans[name] = [1, seconds, seconds]
+        else:
+            stats[0] += 1
+            stats[1] += seconds
+            if seconds > stats[2]:
+                stats[2] = seconds
+
+class Span:
+    __slots__ = ("name", "start")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        record(self.name, time.perf_counter() - self.start)
+
+def span(name):
+    """Context manager timing its block as span name"""
+    return Span(name) if enabled else NULL_SPAN
+
+def timed(name):
+    """Decorator timing every call as span name; returns the function itself when disabled"""
+    def decorate(func):
+        if not enabled:
+            return func
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                record(name, time.perf_counter() - start)
+        return wrapper
+    return decorate
+
+def span_stats():
+    with spans_lock:
+        return {name: {"calls": calls, "total_seconds": round(total, 6),
+                       "mean_ms": round(total / calls * 1000, 3), "max_ms": round(longest * 1000, 3)}
+                for name, (calls, total, longest) in sorted(spans.items())}
+
+class Sampler:
+    """Counts the stacks of every other thread, sampled from a background thread"""
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="instrumentation-sampler", daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def _run(self):
+        skip = {thread.ident for thread in threading.enumerate() if thread.name.startswith("instrumentation-")}
+        skip.add(threading.get_ident())
+        while not self.stopped.wait(self.interval):
+            for ident, frame in sys._current_frames().items():
+                if ident in skip:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def dump(self, path):
+        with open(path, "w") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+class Instrumentation:
+    """Profiler and tracemalloc state of this process, driven by signals or the control socket"""
+
+    def __init__(self, service, directory):
+        self.service = service
+        self.directory = directory
+        self.profiler = None
+        self.previous_snapshot = None
+        self.dumps = itertools.count(1)
+        # Commands for the worker; deque.append and writing the wakeup pipe
+        # take no locks, so the signal handlers can use them too
+        self.pending = collections.deque()
+        self.wakeup_r, self.wakeup_w = os.pipe()
+        os.set_blocking(self.wakeup_w, False)
+        self.worker = threading.Thread(target=self.work, name="instrumentation-worker", daemon=True)
+        # cProfile only sees the thread that enabled it: the worker leaves
+        # profiler.enable or disable here and the SIGUSR1 handler calls it
+        self.switch = None
+        self.signals = False
+
+    def path(self, kind, extension):
+        stamp = time.strftime("%Y%m%dT%H%M%S")
+        return os.path.join(self.directory, f"{self.service}-{os.getpid()}-{stamp}-{next(self.dumps)}-{kind}.{extension}")
+
+    def write_spans(self):
+        path = self.path("spans", "json")
+        with open(path, "w") as f:
+            json.dump(span_stats(), f, indent=2)
+        return path
+
+    def on_main_thread(self, switch):
+        """Call switch, profiler.enable or disable, on the main thread"""
+        if threading.current_thread() is threading.main_thread():
+            switch()
+            return
+        if not self.signals:
+            raise RuntimeError("cProfile needs the signal handlers, which were not installed")
+        self.switch = switch
+        os.kill(os.getpid(), signal.SIGUSR1)
+        deadline = time.monotonic() + 10
+        while self.switch is not None:
+            if time.monotonic() > deadline:
+                self.switch = None
+                raise RuntimeError("The main thread did not respond")
+            time.sleep(0.01)
+
+    def toggle_profile(self):
+        """Start the profiler, or stop it and return the files written"""
+        if self.profiler is None:
+            if PROFILER == "cprofile":
+                profiler = cProfile.Profile()
+                self.on_main_thread(profiler.enable)
+            else:
+                profiler = Sampler(SAMPLE_INTERVAL)
+                profiler.start()
+            self.profiler = profiler
+            logger.info(f"Profiler ({PROFILER}) started")
+            return []
+        profiler = self.profiler
+        if isinstance(profiler, Sampler):
+            profiler.stop()
+            self.profiler = None
+            path = self.path("profile", "folded")
+            profiler.dump(path)
+        else:
+            self.on_main_thread(profiler.disable)
+            self.profiler = None
+            path = self.path("profile", "pstats")
+            profiler.dump_stats(path)
+        files = [path, self.write_spans()]
+        logger.info(f"Profiler stopped, wrote {', '.join(files)}")
+        return files
+
+    def snapshot(self):
+        """Start tracemalloc, or write a snapshot and return the files written"""
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+            self.previous_snapshot = None
+            logger.info(f"tracemalloc started with {TRACEMALLOC_FRAMES} frames")
+            return []
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, __file__),
+        ))
+        dump = self.path("tracemalloc", "snapshot")
+        snapshot.dump(dump)
+        report = self.path("tracemalloc", "txt")
+        current, peak = tracemalloc.get_traced_memory()
+        with open(report, "w") as f:
+            f.write(f"Traced memory: {current} bytes, peak {peak} bytes\n\nLargest allocations:\n")
+            for stat in snapshot.statistics("lineno")[:25]:
+                f.write(f"{stat}\n")
+            if self.previous_snapshot is not None:
+                f.write("\nGrowth since the previous snapshot:\n")
+                for stat in snapshot.compare_to(self.previous_snapshot, "lineno")[:25]:
+                    f.write(f"{stat}\n")
+        self.previous_snapshot = snapshot
+        files = [dump, report, self.write_spans()]
+        logger.info(f"Wrote tracemalloc snapshot {', '.join(files)}")
+        return files
+
+    def stop_tracemalloc(self):
+        tracemalloc.stop()
+        self.previous_snapshot = None
+        logger.info("tracemalloc stopped")
+        return []
+
+    def on_signal(self, signum, frame):
+        switch = self.switch
+        if signum == signal.SIGUSR1 and switch is not None:
+            switch()
+            self.switch = None
+            return
+        self.submit("profile" if signum == signal.SIGUSR1 else "tracemalloc")
+
+    def submit(self, name, results=None):
+        """Queue command name for the worker, which puts its result in results if given"""
+        self.pending.append((name, results))
+        try:
+            os.write(self.wakeup_w, b"\0")
+        except BlockingIOError:
+            pass  # the pipe is full, so the worker wakes up anyway
+
+    def work(self):
+        while True:
+            os.read(self.wakeup_r, 512)
+            while self.pending:
+                name, results = self.pending.popleft()
+                result = self.command(name)
+                if results is not None:
+                    results.put(result)
+
+    def request(self, name):
+        """Run command name on the worker and wait for its result"""
+        results = queue.Queue()
+        self.submit(name, results)
+        try:
+            return results.get(timeout=30)
+        except queue.Empty:
+            return {"ok": False, "error": "Timed out waiting for the instrumentation worker"}
+
+    def command(self, name):
+        actions = {
+            "profile": self.toggle_profile,
+            "tracemalloc": self.snapshot,
+            "tracemalloc-stop": self.stop_tracemalloc,
+            "spans": lambda: [self.write_spans()],
+        }
+        if name == "status":
+            return {"ok": True, "profiling": self.profiler is not None, "profiler": PROFILER,
+                    "tracemalloc": tracemalloc.is_tracing(), "spans": span_stats()}
+        if name not in actions:
+            return {"ok": False, "error": f"Unknown command {name!r}, expected one of "
+                                          f"{', '.join(sorted(actions) + ['status'])}"}
+        try:
+            return {"ok": True, "files": actions[name]()}
+        except Exception as e:
+            logger.error(f"Instrumentation command {name} failed: {e}")
+            return {"ok": False, "error": str(e)}
+
+    def serve_control(self, path):
+        if os.path.exists(path):
+            os.unlink(path)
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(path)
+        listener.listen(4)
+        atexit.register(lambda: os.path.exists(path) and os.unlink(path))
+
+        def serve():
+            while True:
+                conn, _ = listener.accept()
+                try:
+                    with closing(conn), conn.makefile("rwb") as stream:
+                        line = stream.readline().decode(errors="replace").strip()
+                        stream.write(json.dumps(self.request(line)).encode() + b"\n")
+                except OSError as e:
+                    logger.warning(f"Instrumentation control connection failed: {e}")
+
+        threading.Thread(target=serve, name="instrumentation-control", daemon=True).start()
+
+    def finish(self):
+        """Write whatever is still running when the process exits"""
+        profiling, tracing = self.profiler is not None, tracemalloc.is_tracing()
+        if profiling:
+            self.toggle_profile()
+        if tracing:
+            self.snapshot()
+        if not (profiling or tracing) and spans:
+            self.write_spans()
+
+instance = None
+
+def setup(service):
+    """Install the signal handlers and control socket for service; does nothing
+    unless INSTRUMENT_DIR is set. Call from the main thread of the process
+    doing the work (each forwarder worker calls it for itself)."""
+    global instance
+    if not enabled:
+        return None
+    os.makedirs(INSTRUMENT_DIR, exist_ok=True)
+    instance = Instrumentation(service, INSTRUMENT_DIR)
+    instance.worker.start()
+    if threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGUSR1, instance.on_signal)
+        signal.signal(signal.SIGUSR2, instance.on_signal)
+        instance.signals = True
+    else:
+        logger.warning("Instrumentation set up outside the main thread, signals are not handled")
+    control = os.path.join(INSTRUMENT_DIR, f"{service}-{os.getpid()}.sock")
+    try:
+        instance.serve_control(control)
+    except OSError as e:
+        logger.error(f"Could not open instrumentation control socket {control}: {e}")
+    if "profile" in START:
+        instance.toggle_profile()
+    if "tracemalloc" in START:
+        instance.snapshot()
+    atexit.register(instance.finish)
+    logger.info(f"Instrumentation enabled for {service} (pid {os.getpid()}), writing to {INSTRUMENT_DIR}")
+    return instance
@@ -7,7 +7,26 @@ import sys
 import codecs
 import threading
 import logging
-from botocore.exceptions import ClientError
+import random
+import signal
+import collections
+import calendar
+import re
+import struct
+import itertools
+import zlib
+from botocore.config import Config
+from botocore.exceptions import ClientError, BotoCoreError
+from service_metrics import Metrics, serve_metrics
+
+try:
+    from instrumentation import setup as setup_instrumentation, timed
+except ImportError:  # Profiling hooks are optional, see instrumentation.py
+    def setup_instrumentation(service):
+        return None
+
+    def timed(name):
+        return lambda func: func
 
 # Force unbuffered output
 sys.stdout.reconfigure(line_buffering=True)
@@ -19,13 +38,97 @@ log_level = os.environ.get('LOG_LEVEL', 'WARNING').upper()
 logging.basicConfig(level=getattr(logging, log_level), format='[%(asctime)s] %(levelname)s: %(message)s')
 logger = logging.getLogger(__name__)
 
+# PutLogEvents limits: events per call, bytes per call (message bytes plus
+# 26 bytes per event), span of one batch and size of one event
+MAX_BATCH_EVENTS = 10000
+MAX_BATCH_BYTES = 1048576
+EVENT_OVERHEAD = 26
+MAX_BATCH_SPAN_MS = 24 * 60 * 60 * 1000
+MAX_EVENT_BYTES = min(int(os.environ.get('MAX_EVENT_SIZE', 256 * 1024)), 256 * 1024) - EVENT_OVERHEAD
+# CloudWatch silently rejects events older than 14 days or more than 2 hours ahead
+MAX_EVENT_AGE_MS = 14 * 24 * 60 * 60 * 1000 - 60 * 60 * 1000
+MAX_EVENT_SKEW_MS = 2 * 60 * 60 * 1000 - 60 * 1000
+
+# How a connection's byte stream is cut into events: "newline" (one event per
+# line), "length" (4-byte big-endian length before each record) or "raw"
+# (one event per received chunk)
+FRAMING = os.environ.get('FRAMING', 'newline')
+# Take the event time from a leading timestamp or a JSON record's time field
+PARSE_TIMESTAMPS = os.environ.get('PARSE_TIMESTAMPS', '').lower() in ('1', 'true', 'yes')
+
+# Seconds an event may wait before a partial batch is sent
+FLUSH_INTERVAL = float(os.environ.get('FLUSH_INTERVAL', '1.0'))
+# Events and bytes held in memory before connection readers block (or, with
+# a spool, before new events go to disk)
+MAX_QUEUED_EVENTS = int(os.environ.get('MAX_QUEUED_EVENTS', '100000'))
+MAX_QUEUED_BYTES = int(os.environ.get('MAX_QUEUED_BYTES', 64 * 1024 * 1024))
+# Optional disk spool for events the shipper cannot keep up with
+SPOOL_DIR = os.environ.get('SPOOL_DIR')
+SPOOL_MAX_BYTES = int(os.environ.get('SPOOL_MAX_BYTES', 256 * 1024 * 1024))
+SPOOL_SEGMENT_BYTES = int(os.environ.get('SPOOL_SEGMENT_BYTES', 8 * 1024 * 1024))
+# Spread events over several log streams: SHARD_BY "connection" assigns
+# connections to STREAM_SHARDS streams round-robin, "hash" by a hash of the
+# source address and "cid" gives every source CID its own stream; either way
+# all of one connection's events go to one stream, in order
+STREAM_SHARDS = int(os.environ.get('STREAM_SHARDS', '1'))
+SHARD_BY = os.environ.get('SHARD_BY', 'connection')
+# Per-connection limit in events per second (0 disables it) and burst size
+RATE_LIMIT = float(os.environ.get('RATE_LIMIT', '0'))
+RATE_LIMIT_BURST = float(os.environ.get('RATE_LIMIT_BURST', str(RATE_LIMIT * 2)))
+# Collapse runs of identical lines (ignoring a leading timestamp) into one event
+DEDUP = os.environ.get('DEDUP', '').lower() in ('1', 'true', 'yes')
+DEDUP_MAX_REPEATS = 10000
+# Longest a repeat or rate-limit summary is held back, even while a line keeps repeating
+SUMMARY_INTERVAL = float(os.environ.get('SUMMARY_INTERVAL', '5'))
+# The logger's own metrics: a Prometheus endpoint on METRICS_PORT and/or an
+# Embedded Metric Format event every METRICS_INTERVAL seconds
+METRICS_PORT = int(os.environ.get('METRICS_PORT', '0'))
+METRICS_HOST = os.environ.get('METRICS_HOST', '127.0.0.1')
+METRICS_EMF = os.environ.get('METRICS_EMF', '').lower() in ('1', 'true', 'yes')
+METRICS_INTERVAL = float(os.environ.get('METRICS_INTERVAL', '60'))
+METRICS_NAMESPACE = os.environ.get('METRICS_NAMESPACE', 'NitroEnclaves/CloudWatchLogger')
+MAX_RETRY_DELAY = float(os.environ.get('MAX_RETRY_DELAY', '30'))
+
+RETRYABLE_ERRORS = {'ThrottlingException', 'ServiceUnavailableException', 'InternalFailure',
+                    'RequestLimitExceeded', 'LimitExceededException'}
+
+metrics = Metrics()
+metrics.describe("cloudwatch_logger_received_bytes_total", "counter", "Bytes received from enclaves")
+metrics.describe("cloudwatch_logger_received_events_total", "counter", "Events framed from received bytes")
+metrics.describe("cloudwatch_logger_sent_events_total", "counter", "Events accepted by PutLogEvents")
+metrics.describe("cloudwatch_logger_sent_bytes_total", "counter", "Message bytes accepted by PutLogEvents")
+metrics.describe("cloudwatch_logger_batch_events", "histogram", "Events per PutLogEvents call",
+                 buckets=(1, 10, 100, 1000, 5000, 10000))
+metrics.describe("cloudwatch_logger_put_log_events_seconds", "histogram", "PutLogEvents latency",
+                 buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10))
+metrics.describe("cloudwatch_logger_put_log_events_errors_total", "counter", "Failed PutLogEvents calls by error code")
+metrics.describe("cloudwatch_logger_throttles_total", "counter", "PutLogEvents calls throttled")
+metrics.describe("cloudwatch_logger_retries_total", "counter", "PutLogEvents calls retried")
+metrics.describe("cloudwatch_logger_dropped_events_total", "counter", "Events dropped, by reason")
+metrics.describe("cloudwatch_logger_deduplicated_events_total", "counter", "Repeated lines collapsed into a summary")
+metrics.describe("cloudwatch_logger_queued_events", "gauge", "Events waiting in memory")
+metrics.describe("cloudwatch_logger_spool_events", "gauge", "Events waiting in the disk spool")
+metrics.describe("cloudwatch_logger_spool_bytes", "gauge", "Bytes waiting in the disk spool")
+
+RECEIVED_BYTES = metrics.key("cloudwatch_logger_received_bytes_total")
+RECEIVED_EVENTS = metrics.key("cloudwatch_logger_received_events_total")
+SENT_EVENTS = metrics.key("cloudwatch_logger_sent_events_total")
+SENT_BYTES = metrics.key("cloudwatch_logger_sent_bytes_total")
+BATCH_EVENTS = metrics.key("cloudwatch_logger_batch_events")
+PUT_LATENCY = metrics.key("cloudwatch_logger_put_log_events_seconds")
+THROTTLES = metrics.key("cloudwatch_logger_throttles_total")
+RETRIES = metrics.key("cloudwatch_logger_retries_total")
+DEDUPLICATED = metrics.key("cloudwatch_logger_deduplicated_events_total")
+
 def create_cloudwatch_client():
     region = os.environ.get('AWS_REGION', 'us-east-2')
-    return boto3.client('logs', region_name=region)
+    # Every shard's shipper may have a request in flight
+    config = Config(max_pool_connections=max(10, STREAM_SHARDS + 2))
+    return boto3.client('logs', region_name=region, config=config)
 
-def setup_log_group_and_stream(cloudwatch):
+def setup_log_group_and_stream(cloudwatch, log_stream=None):
     log_group = os.environ.get('LOG_GROUP', '/aws/nitro-enclaves/enclave')
-    log_stream = os.environ.get('LOG_STREAM', 'enclave-logs')
+    log_stream = log_stream or os.environ.get('LOG_STREAM', 'enclave-logs')
 
     try:
         cloudwatch.create_log_group(logGroupName=log_group)
@@ -43,53 +146,861 @@ def setup_log_group_and_stream(cloudwatch):
 
     return log_group, log_stream
 
-def handle_client(conn, addr, cloudwatch, log_group, log_stream):
-    logger.debug(f"Connected by {addr}")
-    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
-    try:
-        while True:
-            data = conn.recv(1024)
-            if not data:
+def split_message(message):
+    """Split a message into pieces CloudWatch accepts, without cutting a UTF-8 sequence"""
+    encoded = message.encode()
+    while len(encoded) > MAX_EVENT_BYTES:
+        cut = MAX_EVENT_BYTES
+        while encoded[cut] & 0xC0 == 0x80:
+            cut -= 1
+        yield encoded[:cut]
+        encoded = encoded[cut:]
+    yield encoded
+
+class SpoolBudget:
+    """Disk space shared by several spools, so shards together stay within one limit"""
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.lock = threading.Lock()
+
+    def add(self, size):
+        with self.lock:
+            self.bytes += size
+
+class Spool:
+    """Append-only segment files for events the shipper could not keep up with.
+
+    Each record is a 12-byte header (message length, timestamp) followed by
+    the UTF-8 message. Segments are deleted once fully delivered, and the
+    read position is saved after every delivered batch so anything left at
+    shutdown is replayed on the next start. Once max_bytes are spooled new
+    events are dropped and counted; spools given the same budget share it.
+    """
+    RECORD = struct.Struct('>IQ')
+
+    def __init__(self, directory, max_bytes, segment_bytes, budget=None):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.budget = budget or SpoolBudget(max_bytes)
+        self.max_bytes = self.budget.max_bytes
+        self.segment_bytes = segment_bytes
+        self.lock = threading.Lock()
+        self.writer = None
+        self.spooled = 0
+        self.dropped = 0
+
+        self.segments = sorted(int(name.split('.')[0]) for name in os.listdir(directory)
+                               if name.endswith('.spool'))
+        self.read_segment, self.read_offset = self._load_position()
+        for segment in [segment for segment in self.segments if segment < self.read_segment]:
+            self._remove(segment)
+        if self.segments and self.read_segment < self.segments[0]:
+            self.read_segment, self.read_offset = self.segments[0], 0
+
+        self.bytes = 0
+        self.events = 0
+        for segment in self.segments:
+            offset = complete = self.read_offset if segment == self.read_segment else 0
+            for _, _, _, complete in self._records(segment, offset):
+                self.events += 1
+            if os.path.getsize(self._path(segment)) > complete:
+                # A record torn by a crash; appending after it would garble every later one
+                logger.warning(f"Truncating a partial record at the end of {self._path(segment)}")
+                os.truncate(self._path(segment), complete)
+            self.bytes += complete - offset
+        self.budget.add(self.bytes)
+        if self.events:
+            logger.warning(f"Replaying {self.events} spooled log events from {directory}")
+
+    def _path(self, segment):
+        return os.path.join(self.directory, f"{segment:012d}.spool")
+
+    def _load_position(self):
+        try:
+            with open(os.path.join(self.directory, 'position')) as f:
+                segment, offset = f.read().split()
+                return int(segment), int(offset)
+        except (OSError, ValueError):
+            return (self.segments[0] if self.segments else 0), 0
+
+    def _save_position(self):
+        path = os.path.join(self.directory, 'position')
+        with open(path + '.tmp', 'w') as f:
+            f.write(f"{self.read_segment} {self.read_offset}\n")
+        os.replace(path + '.tmp', path)
+
+    def _remove(self, segment):
+        self.segments.remove(segment)
+        try:
+            os.remove(self._path(segment))
+        except FileNotFoundError:
+            pass
+
+    def _records(self, segment, offset):
+        """Yield (timestamp, message bytes, start, end) from offset to the last complete record"""
+        try:
+            with open(self._path(segment), 'rb') as f:
+                f.seek(offset)
+                while True:
+                    header = f.read(self.RECORD.size)
+                    if len(header) < self.RECORD.size:
+                        return
+                    length, timestamp = self.RECORD.unpack(header)
+                    message = f.read(length)
+                    if len(message) < length:
+                        return
+                    yield timestamp, message, offset, offset + self.RECORD.size + length
+                    offset += self.RECORD.size + length
+        except FileNotFoundError:
+            return
+
+    def append(self, events):
+        """Append (timestamp, message, size) events; returns how many were dropped"""
+        with self.lock:
+            data = bytearray()
+            appended = 0
+            with self.budget.lock:
+                for timestamp, message, _ in events:
+                    encoded = message.encode()
+                    if self.budget.bytes + len(data) + self.RECORD.size + len(encoded) > self.max_bytes:
+                        break
+                    data += self.RECORD.pack(len(encoded), timestamp)
+                    data += encoded
+                    appended += 1
+                # Reserved before writing, so other shards see it straight away
+                self.budget.bytes += len(data)
+            if data:
+                start = None
+                try:
+                    if self.writer is None or self.writer.tell() >= self.segment_bytes:
+                        self._rotate()
+                    start = self.writer.tell()
+                    self.writer.write(data)
+                    self.writer.flush()
+                except OSError:
+                    # Give the space back and leave no partial record behind
+                    self.budget.add(-len(data))
+                    if start is not None:
+                        self._abandon_write(start)
+                    else:
+                        self.writer = None
+                    raise
+            self.bytes += len(data)
+            self.events += appended
+            self.spooled += appended
+            dropped = len(events) - appended
+            self.dropped += dropped
+            return dropped
+
+    def _abandon_write(self, start):
+        """Cut off whatever part of a failed write reached the segment"""
+        path = self._path(self.segments[-1])
+        try:
+            self.writer.close()
+        except OSError:
+            pass
+        self.writer = None
+        try:
+            os.truncate(path, start)
+        except OSError as e:
+            logger.error(f"Could not truncate {path} after a failed write: {e}")
+
+    def _rotate(self):
+        if self.writer is not None:
+            self.writer.close()
+        if self.segments and self.writer is None and \
+                os.path.getsize(self._path(self.segments[-1])) < self.segment_bytes:
+            segment = self.segments[-1]
+        else:
+            segment = self.segments[-1] + 1 if self.segments else 0
+            self.segments.append(segment)
+        self.writer = open(self._path(segment), 'ab')
+
+    def read_batch(self):
+        """Read the oldest events that fit in one PutLogEvents call.
+
+        Returns (events, position); pass position to commit() once the
+        batch has been delivered.
+        """
+        with self.lock:
+            batch, size = [], 0
+            segment, offset = self.read_segment, self.read_offset
+            oldest = newest = None
+            full = False
+            while segment in self.segments:
+                for timestamp, message, start, end in self._records(segment, offset):
+                    event_size = len(message) + EVENT_OVERHEAD
+                    if oldest is not None and (
+                            len(batch) >= MAX_BATCH_EVENTS or size + event_size > MAX_BATCH_BYTES or
+                            max(newest, timestamp) - min(oldest, timestamp) > MAX_BATCH_SPAN_MS):
+                        full = True
+                        offset = start
+                        break
+                    batch.append({'timestamp': timestamp, 'message': message.decode('utf-8', 'replace')})
+                    size += event_size
+                    oldest = timestamp if oldest is None else min(oldest, timestamp)
+                    newest = timestamp if newest is None else max(newest, timestamp)
+                    offset = end
+                if full or segment == self.segments[-1]:
+                    break
+                segment, offset = self.segments[self.segments.index(segment) + 1], 0
+        # Parsed timestamps and events spooled at shutdown can be out of order;
+        # CloudWatch rejects the whole call unless they are sorted
+        batch.sort(key=lambda event: event['timestamp'])
+        return batch, (segment, offset, len(batch), size)
+
+    def commit(self, position, discard=False):
+        """Mark events up to position as delivered; discard drops whatever is left"""
+        segment, offset, events, size = position
+        with self.lock:
+            if discard:
+                self.events = 0
+            else:
+                for old in [old for old in self.segments if old < segment]:
+                    self._remove(old)
+                delivered = size - events * (EVENT_OVERHEAD - self.RECORD.size)
+                self.bytes -= delivered
+                self.budget.add(-delivered)
+                self.events -= events
+                self.read_segment, self.read_offset = segment, offset
+            if not self.events:
+                # Everything is delivered: start the next spell of spooling from a fresh segment
+                if self.writer is not None:
+                    self.writer.close()
+                    self.writer = None
+                for old in list(self.segments):
+                    self._remove(old)
+                self.read_segment, self.read_offset = 0, 0
+                self.budget.add(-self.bytes)
+                self.bytes = 0
+            self._save_position()
+
+    def close(self):
+        with self.lock:
+            if self.writer is not None:
+                self.writer.close()
+                self.writer = None
+
+class LogShipper:
+    """Queues log events from every connection and sends them in batches.
+
+    Connection readers only call enqueue(); a single shipper thread sends
+    a batch once it is full or its oldest event has waited FLUSH_INTERVAL
+    seconds, retrying throttled calls with exponential backoff. With a spool,
+    events that do not fit in memory go to disk instead of blocking the
+    readers, and are sent once the in-memory queue has drained.
+    """
+    def __init__(self, cloudwatch, log_group, log_stream, spool=None):
+        self.cloudwatch = cloudwatch
+        self.put_log_events = timed("put_log_events")(cloudwatch.put_log_events)
+        self.log_group = log_group
+        self.log_stream = log_stream
+        self.spool = spool
+        # Once anything is spooled, new events follow it to disk to keep their order
+        self.spooling = bool(spool and spool.events)
+        self.spool_full = False
+        self.events = collections.deque()
+        self.queued_bytes = 0
+        self.closing = False
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def enqueue(self, records):
+        """Queue (message, timestamp) records; a None timestamp means now"""
+        if not records:
+            return
+        now = int(time.time() * 1000)
+        events = []
+        for message, timestamp in records:
+            if timestamp is None or not now - MAX_EVENT_AGE_MS < timestamp < now + MAX_EVENT_SKEW_MS:
+                timestamp = now
+            for piece in split_message(message):
+                events.append((timestamp, piece.decode(), len(piece) + EVENT_OVERHEAD))
+
+        with self.condition:
+            if self.spool is None:
+                while self._full() and not self.closing:
+                    self.condition.wait()
+            elif self.spooling or self._full():
+                if not self.spooling:
+                    logger.warning("Log shipper is falling behind, spooling events to disk")
+                    self.spooling = True
+                dropped = self.spool.append(events)
+                if dropped and not self.spool_full:
+                    logger.error(f"Spool is full ({self.spool.max_bytes} bytes), dropping new log events")
+                    self.spool_full = True
+                self.condition.notify_all()
+                return
+            self.events.extend(events)
+            self.queued_bytes += sum(event[2] for event in events)
+            self.condition.notify_all()
+
+    def _full(self):
+        return len(self.events) >= MAX_QUEUED_EVENTS or self.queued_bytes >= MAX_QUEUED_BYTES
+
+    def _batch_ready(self, deadline):
+        return (len(self.events) >= MAX_BATCH_EVENTS or self.queued_bytes >= MAX_BATCH_BYTES
+                or time.monotonic() >= deadline or self.closing)
+
+    def _take_batch(self):
+        batch, size = [], 0
+        oldest = newest = self.events[0][0]
+        while self.events and len(batch) < MAX_BATCH_EVENTS:
+            timestamp, message, event_size = self.events[0]
+            if size + event_size > MAX_BATCH_BYTES or \
+                    max(newest, timestamp) - min(oldest, timestamp) > MAX_BATCH_SPAN_MS:
                 break
-            message = decoder.decode(data)
-            if not message:
+            self.events.popleft()
+            batch.append({'timestamp': timestamp, 'message': message})
+            size += event_size
+            oldest, newest = min(oldest, timestamp), max(newest, timestamp)
+        self.queued_bytes -= size
+        self.condition.notify_all()
+        # Parsed timestamps can arrive out of order; CloudWatch wants them sorted
+        batch.sort(key=lambda event: event['timestamp'])
+        return batch
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.events and not self.spooling:
+                    if self.closing:
+                        return
+                    self.condition.wait()
+                if not self.events:
+                    # The spool is replayed once everything in memory, which is older, is sent
+                    if self.closing:
+                        return
+                    batch, position = self.spool.read_batch()
+                    if not batch:
+                        # Only a torn record is left
+                        self.spool.commit(position, discard=True)
+                        self.spooling = False
+                        continue
+                    spooled = True
+                else:
+                    spooled = False
+                    deadline = time.monotonic() + FLUSH_INTERVAL
+                    while not self._batch_ready(deadline):
+                        self.condition.wait(max(0, deadline - time.monotonic()))
+                    batch = self._take_batch()
+
+            if not spooled:
+                if not self.send(batch) and self.spool is not None:
+                    self.spool.append([(event['timestamp'], event['message'], 0) for event in batch])
                 continue
-            logger.debug("Forwarding log to CloudWatch")
+
+            if not self.send(batch):
+                return
+            with self.condition:
+                self.spool.commit(position)
+                if not self.spool.events:
+                    logger.warning("Spool drained, sending from memory again")
+                    self.spooling = False
+                    self.spool_full = False
+
+    def send(self, batch):
+        """Deliver a batch; False if it was given up on at shutdown"""
+        delay = 0.2
+        while True:
+            start = time.monotonic()
             try:
-                cloudwatch.put_log_events(
-                    logGroupName=log_group,
-                    logStreamName=log_stream,
-                    logEvents=[{
-                        'timestamp': int(time.time() * 1000),
-                        'message': message
-                    }]
+                logger.debug(f"Forwarding {len(batch)} log events to CloudWatch")
+                self.put_log_events(
+                    logGroupName=self.log_group,
+                    logStreamName=self.log_stream,
+                    logEvents=batch
                 )
-            except Exception as e:
-                logger.error(f"Error sending log to CloudWatch: {e}")
+                metrics.observe(PUT_LATENCY, time.monotonic() - start)
+                metrics.observe(BATCH_EVENTS, len(batch))
+                metrics.inc(SENT_EVENTS, len(batch))
+                metrics.inc(SENT_BYTES, sum(len(event['message'].encode()) for event in batch))
+                return True
+            except ClientError as e:
+                metrics.observe(PUT_LATENCY, time.monotonic() - start)
+                code = e.response['Error']['Code']
+                metrics.inc(metrics.key("cloudwatch_logger_put_log_events_errors_total", code=code))
+                if code == 'ThrottlingException':
+                    metrics.inc(THROTTLES)
+                if code == 'ResourceNotFoundException':
+                    logger.warning("Log group or stream is missing, recreating it")
+                    try:
+                        setup_log_group_and_stream(self.cloudwatch, self.log_stream)
+                    except (ClientError, BotoCoreError) as setup_error:
+                        logger.warning(f"Could not recreate log stream {self.log_stream}: {setup_error}")
+                elif code not in RETRYABLE_ERRORS:
+                    logger.error(f"Dropping {len(batch)} log events rejected by CloudWatch: {e}")
+                    metrics.inc(metrics.key("cloudwatch_logger_dropped_events_total", reason="rejected"), len(batch))
+                    return True
+                error = e
+            except BotoCoreError as e:
+                metrics.inc(metrics.key("cloudwatch_logger_put_log_events_errors_total", code=type(e).__name__))
+                error = e
+            if self.closing and self.spool is not None:
+                # The spool keeps the events for the next start
+                return False
+            if self.closing and delay >= MAX_RETRY_DELAY:
+                logger.error(f"Dropping {len(batch)} log events at shutdown: {error}")
+                metrics.inc(metrics.key("cloudwatch_logger_dropped_events_total", reason="shutdown"), len(batch))
+                return True
+            metrics.inc(RETRIES)
+            logger.warning(f"Error sending logs to CloudWatch, retrying in {delay:.1f}s: {error}")
+            time.sleep(delay * random.uniform(0.5, 1.0))
+            delay = min(delay * 2, MAX_RETRY_DELAY)
+
+    def connection(self, addr):
+        """The enqueue function for a new connection"""
+        return self.enqueue
+
+    def close(self, timeout=10):
+        """Send whatever is queued, waiting up to timeout seconds"""
+        with self.condition:
+            self.closing = True
+            self.condition.notify_all()
+        self.thread.join(timeout)
+        with self.condition:
+            if self.events and self.spool is not None:
+                self.spool.append(list(self.events))
+                logger.warning(f"Spooled {len(self.events)} queued log events at shutdown")
+            elif self.events:
+                logger.error(f"Dropped {len(self.events)} queued log events at shutdown")
+            self.events.clear()
+        if self.spool is not None:
+            self.spool.close()
+
+    def stats(self):
+        with self.condition:
+            stats = {'queued_events': len(self.events), 'queued_bytes': self.queued_bytes}
+        if self.spool is not None:
+            stats.update(spool_events=self.spool.events, spool_bytes=self.spool.bytes,
+                         spooled_total=self.spool.spooled, spool_dropped_total=self.spool.dropped)
+        return stats
+
+class ShardedShipper:
+    """Spreads events over several log streams, each with its own LogShipper.
+
+    A shard's stream is created, and its shipper started, the first time
+    it is used; with a spool every shard gets its own subdirectory, and all
+    of them share SPOOL_MAX_BYTES. If the stream cannot be created then, the
+    shipper still starts and creates it when PutLogEvents reports it missing.
+    """
+    def __init__(self, cloudwatch, log_group, log_stream, shard_by, shards):
+        self.cloudwatch = cloudwatch
+        self.log_group = log_group
+        self.log_stream = log_stream
+        self.shard_by = shard_by
+        self.shards = shards
+        self.lock = threading.Lock()
+        self.shippers = {}
+        self.next_shard = itertools.count()
+        self.spool_budget = SpoolBudget(SPOOL_MAX_BYTES)
+
+    def start(self):
+        # Replay whatever earlier runs left spooled for any shard
+        if SPOOL_DIR and os.path.isdir(SPOOL_DIR):
+            for name in sorted(os.listdir(SPOOL_DIR)):
+                if os.path.isdir(os.path.join(SPOOL_DIR, name)):
+                    self.shipper(name)
+
+    def shipper(self, log_stream):
+        with self.lock:
+            shipper = self.shippers.get(log_stream)
+            if shipper is not None:
+                return shipper
+            spool = Spool(os.path.join(SPOOL_DIR, log_stream), SPOOL_MAX_BYTES, SPOOL_SEGMENT_BYTES,
+                          self.spool_budget) if SPOOL_DIR else None
+            shipper = LogShipper(self.cloudwatch, self.log_group, log_stream, spool)
+            shipper.start()
+            self.shippers[log_stream] = shipper
+        # Outside the lock, so a slow or failing CreateLogStream only holds up
+        # this connection; a send that finds the stream missing creates it
+        try:
+            setup_log_group_and_stream(self.cloudwatch, log_stream)
+        except (ClientError, BotoCoreError) as e:
+            logger.warning(f"Could not create log stream {log_stream}, retrying on first send: {e}")
+        logger.info(f"Shipping to log stream {log_stream}")
+        return shipper
 
-        remaining = decoder.decode(b'', final=True)
-        if remaining:
-            logger.debug("Forwarding log to CloudWatch")
+    def connection(self, addr):
+        """The enqueue function for a new connection"""
+        if self.shard_by == 'cid':
+            cid = addr[0] if isinstance(addr, tuple) else 'unknown'
+            return self.shipper(f"{self.log_stream}-cid-{cid}").enqueue
+        if self.shard_by == 'connection':
+            shard = next(self.next_shard) % self.shards
+        else:
+            # Hash the source, not each event, so a connection's lines stay
+            # together and in order within one stream
+            shard = zlib.crc32(repr(addr).encode()) % self.shards
+        return self.shipper(f"{self.log_stream}-{shard}").enqueue
+
+    def close(self, timeout=10):
+        with self.lock:
+            shippers = list(self.shippers.values())
+        closers = [threading.Thread(target=shipper.close, args=(timeout,)) for shipper in shippers]
+        for closer in closers:
+            closer.start()
+        for closer in closers:
+            closer.join()
+
+    def stats(self):
+        with self.lock:
+            shippers = dict(self.shippers)
+        return {log_stream: shipper.stats() for log_stream, shipper in shippers.items()}
+
+LEADING_TIMESTAMP = re.compile(
+    r'\[?(\d{4})-(\d{2})-(\d{2})[T ](\d{2}):(\d{2}):(\d{2})(?:[.,](\d+))?\s?(Z|[+-]\d{2}:?\d{2})?')
+JSON_TIME_FIELDS = ('timestamp', '@timestamp', 'time', 'ts')
+
+def parse_time(value):
+    """Milliseconds since the epoch from epoch seconds/milliseconds or an ISO 8601 string"""
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        # Anything this large is already in milliseconds
+        return int(value if value > 1e11 else value * 1000)
+    if not isinstance(value, str):
+        return None
+    match = LEADING_TIMESTAMP.match(value)
+    if not match:
+        return None
+    year, month, day, hour, minute, second, fraction, zone = match.groups()
+    try:
+        seconds = calendar.timegm((int(year), int(month), int(day), int(hour), int(minute), int(second)))
+    except ValueError:
+        return None
+    if zone and zone != 'Z':
+        sign = -1 if zone[0] == '-' else 1
+        seconds -= sign * (int(zone[1:3]) * 3600 + int(zone[-2:]) * 60)
+    milliseconds = int((fraction or '0')[:3].ljust(3, '0'))
+    return seconds * 1000 + milliseconds
+
+def record_timestamp(message):
+    """The time a record was written, if it starts with one; naive times are taken as UTC"""
+    if message.startswith('{'):
+        try:
+            record = json.loads(message)
+        except ValueError:
+            return None
+        if isinstance(record, dict):
+            for field in JSON_TIME_FIELDS:
+                if field in record:
+                    return parse_time(record[field])
+        return None
+    return parse_time(message)
+
+class LineFramer:
+    """Cuts decoded text into one event per line.
+
+    Partial lines are kept as a list of pieces and joined once the newline
+    arrives, so long lines are not re-copied on every chunk. A line longer
+    than MAX_EVENT_BYTES of UTF-8 is sent in parts of that size.
+    """
+    def __init__(self):
+        self.decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        self.pending = []
+        self.pending_size = 0
+
+    def _text(self, text):
+        lines = text.split('\n')
+        messages = []
+        if len(lines) > 1:
+            self.pending.append(lines[0])
+            messages.append(''.join(self.pending))
+            messages.extend(lines[1:-1])
+            self.pending = []
+            self.pending_size = 0
+        tail = lines[-1]
+        if tail:
+            self.pending.append(tail)
+            self.pending_size += len(tail.encode())
+            if self.pending_size >= MAX_EVENT_BYTES:
+                # Send full-size parts now and keep the remainder for the rest of the line
+                *parts, rest = split_message(''.join(self.pending))
+                if len(rest) == MAX_EVENT_BYTES:
+                    parts.append(rest)
+                    rest = b''
+                messages.extend(part.decode() for part in parts)
+                self.pending = [rest.decode()] if rest else []
+                self.pending_size = len(rest)
+        return [message.rstrip('\r') for message in messages if message.strip()]
+
+    def feed(self, data):
+        return self._text(self.decoder.decode(data))
+
+    def finish(self):
+        return self._text(self.decoder.decode(b'', final=True) + '\n')
+
+class LengthFramer:
+    """Cuts the stream into records that are each preceded by a 4-byte big-endian length.
+
+    A record longer than MAX_EVENT_BYTES is rejected, which closes the connection.
+    """
+    HEADER = struct.Struct('>I')
+
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def feed(self, data):
+        self.buffer += data
+        messages = []
+        view = memoryview(self.buffer)
+        offset = 0
+        while len(self.buffer) - offset >= self.HEADER.size:
+            (length,) = self.HEADER.unpack_from(self.buffer, offset)
+            if length > MAX_EVENT_BYTES:
+                if offset:
+                    # Hand over the records before it; the next feed rejects it
+                    break
+                # Most likely a sender that is not length-framing at all
+                raise ValueError(f"Record of {length} bytes exceeds the {MAX_EVENT_BYTES} byte event limit")
+            end = offset + self.HEADER.size + length
+            if end > len(self.buffer):
+                break
+            if length:
+                messages.append(str(view[offset + self.HEADER.size:end], 'utf-8', 'replace'))
+            offset = end
+        view.release()
+        # Compact once per chunk rather than once per record
+        del self.buffer[:offset]
+        return messages
+
+    def finish(self):
+        if self.buffer:
+            logger.warning(f"Discarding {len(self.buffer)} bytes of a truncated record")
+        return []
+
+class RawFramer:
+    """One event per received chunk, as sent by the enclave"""
+    def __init__(self):
+        self.decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+
+    def feed(self, data):
+        message = self.decoder.decode(data)
+        return [message] if message else []
+
+    def finish(self):
+        message = self.decoder.decode(b'', final=True)
+        return [message] if message else []
+
+FRAMERS = {'newline': LineFramer, 'length': LengthFramer, 'raw': RawFramer}
+
+def to_records(messages):
+    if PARSE_TIMESTAMPS:
+        return [(message, record_timestamp(message)) for message in messages]
+    return [(message, None) for message in messages]
+
+class EventFilter:
+    """Per-connection noise suppression: collapses runs of identical lines and
+    enforces a token-bucket rate limit, replacing what was held back with a
+    single summary event. Summaries are written at least every
+    SUMMARY_INTERVAL seconds and are never rate limited themselves.
+    """
+    def __init__(self, rate=RATE_LIMIT, burst=RATE_LIMIT_BURST, dedup=DEDUP):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.limited = 0
+        self.dedup = dedup
+        self.last_line = None
+        self.repeats = 0
+        self.summarized = time.monotonic()
+
+    def _line(self, message):
+        # Lines in an error loop usually differ only in their timestamp
+        match = LEADING_TIMESTAMP.match(message)
+        return message[match.end():] if match else message
+
+    def _repeat_summary(self):
+        if not self.repeats:
+            return []
+        metrics.inc(DEDUPLICATED, self.repeats)
+        summary = (f"[cloudwatch_logger] previous line repeated {self.repeats} more times", None)
+        self.repeats = 0
+        return [summary]
+
+    def _allow(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    def _limit_summary(self):
+        if not self.limited:
+            return []
+        metrics.inc(metrics.key("cloudwatch_logger_dropped_events_total", reason="rate_limited"), self.limited)
+        summary = (f"[cloudwatch_logger] dropped {self.limited} events over the limit of {self.rate:g} events/s", None)
+        self.limited = 0
+        return [summary]
+
+    def apply(self, records):
+        passed = self.flush()
+        for record in records:
+            if self.dedup:
+                line = self._line(record[0])
+                if line == self.last_line and self.repeats < DEDUP_MAX_REPEATS:
+                    self.repeats += 1
+                    continue
+                passed.extend(self._repeat_summary())
+                self.last_line = line
+            if self.rate and not self._allow():
+                self.limited += 1
+                continue
+            passed.extend(self._limit_summary())
+            passed.append(record)
+        return passed
+
+    def flush(self):
+        """Summaries that have been held back for SUMMARY_INTERVAL seconds"""
+        if (self.repeats or self.limited) and time.monotonic() - self.summarized >= SUMMARY_INTERVAL:
+            return self.finish()
+        return []
+
+    def finish(self):
+        """Summaries still owed, e.g. when the connection closes"""
+        self.summarized = time.monotonic()
+        return self._repeat_summary() + self._limit_summary()
+
+def handle_client(conn, addr, shipper):
+    logger.debug(f"Connected by {addr}")
+    framer = FRAMERS[FRAMING]()
+    event_filter = EventFilter() if RATE_LIMIT or DEDUP else None
+    try:
+        enqueue = shipper.connection(addr)
+        if event_filter is not None:
+            # Wake up to write summaries that are due while the enclave is quiet
+            conn.settimeout(SUMMARY_INTERVAL)
+        while True:
             try:
-                cloudwatch.put_log_events(
-                    logGroupName=log_group,
-                    logStreamName=log_stream,
-                    logEvents=[{
-                        'timestamp': int(time.time() * 1000),
-                        'message': remaining
-                    }]
-                )
-            except Exception as e:
-                logger.error(f"Error sending log to CloudWatch: {e}")
+                data = conn.recv(65536)
+            except socket.timeout:
+                enqueue(event_filter.flush())
+                continue
+            if not data:
+                break
+            metrics.inc(RECEIVED_BYTES, len(data))
+            records = to_records(framer.feed(data))
+            metrics.inc(RECEIVED_EVENTS, len(records))
+            if event_filter is not None:
+                records = event_filter.apply(records)
+            enqueue(records)
+
+        records = to_records(framer.finish())
+        metrics.inc(RECEIVED_EVENTS, len(records))
+        if event_filter is not None:
+            records = event_filter.apply(records) + event_filter.finish()
+        enqueue(records)
     except Exception as e:
         logger.error(f"Error handling connection: {e}")
     finally:
         conn.close()
         logger.debug(f"Connection closed for {addr}")
 
+def shipper_totals(shipper):
+    """LogShipper.stats() summed over every shard"""
+    stats = shipper.stats()
+    totals = collections.Counter()
+    for stream_stats in (stats.values() if isinstance(shipper, ShardedShipper) else [stats]):
+        totals.update(stream_stats)
+    return totals
+
+def add_emf_header(request, **kwargs):
+    # Tells CloudWatch Logs to extract metrics from the events
+    request.headers['x-amzn-logs-format'] = 'json/emf'
+
+EMF_METRICS = (
+    ("EventsReceived", "Count", "cloudwatch_logger_received_events_total"),
+    ("BytesReceived", "Bytes", "cloudwatch_logger_received_bytes_total"),
+    ("EventsSent", "Count", "cloudwatch_logger_sent_events_total"),
+    ("BytesSent", "Bytes", "cloudwatch_logger_sent_bytes_total"),
+    ("Throttles", "Count", "cloudwatch_logger_throttles_total"),
+    ("Retries", "Count", "cloudwatch_logger_retries_total"),
+    ("EventsDropped", "Count", "cloudwatch_logger_dropped_events_total"),
+    ("EventsDeduplicated", "Count", "cloudwatch_logger_deduplicated_events_total"),
+)
+
+def emf_document(current, previous, log_group):
+    """One Embedded Metric Format record covering the interval between two snapshots"""
+    values = {name: metrics.total(current, series) - metrics.total(previous, series) for name, _, series in EMF_METRICS}
+    units = {name: unit for name, unit, _ in EMF_METRICS}
+    latency_sum, calls = (now - before for now, before in zip(
+        metrics.total(current, "cloudwatch_logger_put_log_events_seconds"),
+        metrics.total(previous, "cloudwatch_logger_put_log_events_seconds")))
+    values["PutLogEventsCalls"], units["PutLogEventsCalls"] = calls, "Count"
+    values["PutLogEventsLatency"] = round(latency_sum / calls * 1000, 3) if calls else 0
+    units["PutLogEventsLatency"] = "Milliseconds"
+    values["QueueDepth"], units["QueueDepth"] = metrics.total(current, "cloudwatch_logger_queued_events"), "Count"
+    values["SpoolEvents"], units["SpoolEvents"] = metrics.total(current, "cloudwatch_logger_spool_events"), "Count"
+    return dict({
+        "_aws": {
+            "Timestamp": int(time.time() * 1000),
+            "CloudWatchMetrics": [{
+                "Namespace": METRICS_NAMESPACE,
+                "Dimensions": [["LogGroup"]],
+                "Metrics": [{"Name": name, "Unit": units[name]} for name in values],
+            }],
+        },
+        "LogGroup": log_group,
+    }, **values)
+
+def publish_emf(log_group, log_stream):
+    """Put one EMF record every METRICS_INTERVAL seconds into log_stream"""
+    cloudwatch = create_cloudwatch_client()
+    cloudwatch.meta.events.register('before-sign.logs.PutLogEvents', add_emf_header)
+    previous = metrics.snapshot()
+    ready = False
+    while True:
+        time.sleep(METRICS_INTERVAL)
+        current = metrics.snapshot()
+        try:
+            if not ready:
+                setup_log_group_and_stream(cloudwatch, log_stream)
+                ready = True
+            cloudwatch.put_log_events(
+                logGroupName=log_group,
+                logStreamName=log_stream,
+                logEvents=[{
+                    'timestamp': int(time.time() * 1000),
+                    'message': json.dumps(emf_document(current, previous, log_group))
+                }]
+            )
+        except (ClientError, BotoCoreError) as e:
+            logger.warning(f"Error publishing metrics to CloudWatch: {e}")
+        previous = current
+
 def socket_to_cloudwatch(port):
     cloudwatch = create_cloudwatch_client()
-    log_group, log_stream = setup_log_group_and_stream(cloudwatch)
+    if STREAM_SHARDS > 1 or SHARD_BY == 'cid':
+        log_group = os.environ.get('LOG_GROUP', '/aws/nitro-enclaves/enclave')
+        log_stream = os.environ.get('LOG_STREAM', 'enclave-logs')
+        shipper = ShardedShipper(cloudwatch, log_group, log_stream, SHARD_BY, STREAM_SHARDS)
+    else:
+        log_group, log_stream = setup_log_group_and_stream(cloudwatch)
+        spool = Spool(SPOOL_DIR, SPOOL_MAX_BYTES, SPOOL_SEGMENT_BYTES) if SPOOL_DIR else None
+        shipper = LogShipper(cloudwatch, log_group, log_stream, spool)
+    shipper.start()
+
+    def collect():
+        totals = shipper_totals(shipper)
+        metrics.set(metrics.key("cloudwatch_logger_queued_events"), totals['queued_events'])
+        if SPOOL_DIR:
+            metrics.set(metrics.key("cloudwatch_logger_spool_events"), totals['spool_events'])
+            metrics.set(metrics.key("cloudwatch_logger_spool_bytes"), totals['spool_bytes'])
+            metrics.set(metrics.key("cloudwatch_logger_dropped_events_total", reason="spool_full"),
+                        totals['spool_dropped_total'])
+    metrics.add_collector(collect)
+    if METRICS_PORT:
+        serve_metrics(METRICS_HOST, METRICS_PORT, lambda: metrics.render(metrics.snapshot()))
+    if METRICS_EMF:
+        threading.Thread(target=publish_emf, args=(log_group, f"{log_stream}-metrics"), daemon=True).start()
 
     sock = socket.socket(socket.AF_VSOCK, socket.SOCK_STREAM)
     cid = socket.VMADDR_CID_ANY
@@ -98,14 +1009,25 @@ def socket_to_cloudwatch(port):
 
     logger.info(f"Listening for logs on port {port}")
 
-    while True:
-        try:
-            conn, addr = sock.accept()
-            threading.Thread(target=handle_client, args=(conn, addr, cloudwatch, log_group, log_stream)).start()
-        except Exception as e:
-            logger.error(f"Error accepting connection: {e}")
-            time.sleep(1)  # Add a small delay before retrying
+    try:
+        while True:
+            try:
+                conn, addr = sock.accept()
+                threading.Thread(target=handle_client, args=(conn, addr, shipper), daemon=True).start()
+            except Exception as e:
+                logger.error(f"Error accepting connection: {e}")
+                time.sleep(1)  # Add a small delay before retrying
+    finally:
+        sock.close()
+        shipper.close()
 
 if __name__ == "__main__":
     port = int(os.environ.get('VSOCK_PORT', 8011))
+    if FRAMING not in FRAMERS:
+        sys.exit(f"FRAMING must be one of: {', '.join(FRAMERS)}")
+    if SHARD_BY not in ('connection', 'hash', 'cid') or STREAM_SHARDS < 1:
+        sys.exit("SHARD_BY must be connection, hash or cid and STREAM_SHARDS at least 1")
+    # Exit through the finally block so queued events are sent
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    setup_instrumentation("cloudwatch_logger")
     socket_to_cloudwatch(port)
@@ -0,0 +1,51 @@
+import os
+
+import pytest
+
+import cloudwatch_logger
+from cloudwatch_logger import Spool
+
+def test_spool_replays_appends_after_torn_tail(tmp_path):
+    spool = Spool(str(tmp_path), 1 << 20, 1 << 20)
+    spool.append([(1, "before-crash", 0)])
+    spool.close()
+
+    # A crash in the middle of a write leaves a header and part of the message
+    with open(os.path.join(tmp_path, "000000000000.spool"), "ab") as f:
+        f.write(Spool.RECORD.pack(40, 2) + b"partial")
+
+    spool = Spool(str(tmp_path), 1 << 20, 1 << 20)
+    assert spool.events == 1
+    spool.append([(3, "after-restart", 0), (4, "later", 0)])
+    batch, position = spool.read_batch()
+    assert [event["message"] for event in batch] == ["before-crash", "after-restart", "later"]
+    assert position[2] == spool.events == 3
+
+def test_spool_releases_budget_when_write_fails(tmp_path, monkeypatch):
+    budget = cloudwatch_logger.SpoolBudget(1 << 20)
+    spool = Spool(str(tmp_path), 1 << 20, 1 << 20, budget)
+    spool.append([(1, "kept", 0)])
+    used = budget.bytes
+
+    def fail(data):
+        raise OSError("disk full")
+    monkeypatch.setattr(spool.writer, "write", fail)
+    with pytest.raises(OSError):
+        spool.append([(2, "lost", 0)])
+    assert budget.bytes == used
+
+    spool.append([(3, "next", 0)])
+    assert [event["message"] for event in spool.read_batch()[0]] == ["kept", "next"]
+
+def test_line_framer_splits_long_lines_by_bytes():
+    framer = cloudwatch_logger.LineFramer()
+    data = ("é" * 200000 + "\n").encode()
+    messages = []
+    for start in range(0, len(data), 65536):
+        messages += framer.feed(data[start:start + 65536])
+    messages += framer.finish()
+    sizes = [len(message.encode()) for message in messages]
+    assert sizes[0] == cloudwatch_logger.MAX_EVENT_BYTES
+    assert all(size <= cloudwatch_logger.MAX_EVENT_BYTES for size in sizes)
+    assert "".join(messages) == "é" * 200000
+    assert len(messages) == 2
@@ -0,0 +1,129 @@
+"""Metrics registry and Prometheus endpoint shared by the toolkit's services.
+
+traffic_forwarder.py imports it from the same directory; the cloudwatch_logger
+image ships it next to cloudwatch_logger.py.
+"""
+import bisect
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger("service_metrics")
+
+class Metrics:
+    """Thread-safe counters, gauges and histograms, rendered in Prometheus text format.
+
+    Series are addressed by keys from key(name, **labels), which hot paths
+    build once per connection and reuse. snapshot() returns plain data so
+    worker processes can ship it to a supervisor, which merges them.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.meta = {}  # name -> (type, help, buckets)
+        self.values = {}  # key -> float, or [bucket counts..., sum, count] for histograms
+        self.collectors = []
+
+    def describe(self, name, kind, help_text, buckets=None):
+        self.meta[name] = (kind, help_text, tuple(buckets) if buckets else None)
+
+    @staticmethod
+    def key(name, **labels):
+        return (name, tuple(sorted(labels.items())))
+
+    def inc(self, key, amount=1):
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def set(self, key, value):
+        with self.lock:
+            self.values[key] = value
+
+    def observe(self, key, value):
+        buckets = self.meta[key[0]][2]
+        with self.lock:
+            series = self.values.get(key)
+            if series is None:
+                series = self.values[key] = [0] * (len(buckets) + 2)
+            series[bisect.bisect_left(buckets, value)] += 1  # The last bucket is +Inf
+            series[-2] += value
+            series[-1] += 1
+
+    def add_collector(self, collector):
+        """collector() is called before every snapshot to refresh derived values"""
+        self.collectors.append(collector)
+
+    def snapshot(self):
+        for collector in self.collectors:
+            collector()
+        with self.lock:
+            return {key: list(value) if isinstance(value, list) else value for key, value in self.values.items()}
+
+    def total(self, snapshot, name):
+        """Sum of a counter or gauge across labels; (sum, count) for a histogram"""
+        series = [value for (series_name, _), value in snapshot.items() if series_name == name]
+        if self.meta[name][0] == "histogram":
+            return sum(value[-2] for value in series), sum(value[-1] for value in series)
+        return sum(series)
+
+    def merge(self, snapshots, gauges=True):
+        merged = {}
+        for snapshot in snapshots:
+            for key, value in snapshot.items():
+                if not gauges and self.meta[key[0]][0] == "gauge":
+                    continue
+                if isinstance(value, list):
+                    current = merged.setdefault(key, [0] * len(value))
+                    merged[key] = [a + b for a, b in zip(current, value)]
+                else:
+                    merged[key] = merged.get(key, 0) + value
+        return merged
+
+    def render(self, snapshot):
+        lines = []
+        for name, (kind, help_text, buckets) in sorted(self.meta.items()):
+            series = sorted((key, value) for key, value in snapshot.items() if key[0] == name)
+            if not series:
+                continue
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for (_, labels), value in series:
+                if kind != "histogram":
+                    lines.append(f"{name}{self._labels(labels)} {value}")
+                    continue
+                cumulative = 0
+                for bound, count in zip(buckets + ("+Inf",), value[:-2]):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{self._labels(labels + (('le', bound),))} {cumulative}")
+                lines.append(f"{name}_sum{self._labels(labels)} {value[-2]}")
+                lines.append(f"{name}_count{self._labels(labels)} {value[-1]}")
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def _labels(labels):
+        if not labels:
+            return ""
+        return "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}"
+
+def serve_metrics(host, port, render):
+    """Serve render() as text/plain on http://host:port/metrics from a daemon thread"""
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] not in ("/metrics", "/"):
+                self.send_error(404)
+                return
+            body = render().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass  # Scrapes would otherwise log a line each
+
+    httpd = ThreadingHTTPServer((host, port), Handler)
+    httpd.daemon_threads = True
+    threading.Thread(target=httpd.serve_forever, name="metrics-http", daemon=True).start()
+    logger.info(f"Serving metrics on http://{host}:{port}/metrics")
+    return httpd
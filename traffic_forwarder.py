@@ -5,6 +5,33 @@ import time
 import logging
 import signal
 import os
+import errno
+import argparse
+import selectors
+import select
+import collections
+import json
+import multiprocessing
+import multiprocessing.connection
+import struct
+import heapq
+import itertools
+
+from service_metrics import Metrics, serve_metrics
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - not on Linux
+    fcntl = None
+
+try:
+    from instrumentation import setup as setup_instrumentation, timed
+except ImportError:  # Profiling hooks are optional, see instrumentation.py
+    def setup_instrumentation(service):
+        return None
+
+    def timed(name):
+        return lambda func: func
 
 # Set up logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -19,34 +46,273 @@ def signal_handler(sig, frame):
 signal.signal(signal.SIGINT, signal_handler)
 signal.signal(signal.SIGTERM, signal_handler)
 
-def forward(source, destination, connection_id, direction):
-    """Forward data between sockets with proper cleanup"""
+# Per-connection lines go through their own logger so they can be silenced in
+# favour of periodic summaries (--log-summary-interval) without hiding errors
+connection_log = logging.getLogger("traffic_forwarder.connections")
+
+metrics = Metrics()
+metrics.describe("forwarder_connections_active", "gauge", "Connections currently being relayed")
+metrics.describe("forwarder_connections_accepted_total", "counter", "Client connections accepted")
+metrics.describe("forwarder_bytes_total", "counter", "Bytes relayed per direction")
+metrics.describe("forwarder_errors_total", "counter", "Connect and forwarding errors by errno")
+metrics.describe("forwarder_vsock_connect_seconds", "histogram", "Time to establish the VSOCK connection",
+                 buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1, 5, 30))
+metrics.describe("forwarder_connection_duration_seconds", "histogram", "Connection lifetime from accept to close",
+                 buckets=(0.005, 0.025, 0.1, 0.5, 1, 5, 30, 60, 300, 1800, 3600))
+metrics.describe("forwarder_pool_hits_total", "counter", "Accepted clients paired with a pooled VSOCK connection")
+metrics.describe("forwarder_pool_misses_total", "counter", "Accepted clients that found the VSOCK pool empty")
+metrics.describe("forwarder_pool_idle", "gauge", "Idle pre-connected VSOCK connections")
+metrics.describe("forwarder_connections_rejected_total", "counter", "Connections refused by admission control")
+metrics.describe("forwarder_accept_queue_depth", "gauge", "Accepted connections waiting for a free slot")
+metrics.describe("forwarder_connections_timed_out_total", "counter",
+                 "Connections shut down for idling or outliving max_lifetime, by reason")
+
+def count_error(route, e):
+    name = errno.errorcode.get(e.errno, str(e.errno)) if isinstance(e, OSError) and e.errno else type(e).__name__
+    metrics.inc(metrics.key("forwarder_errors_total", route=route.local, errno=name))
+
+def log_summaries(interval):
+    """Log one aggregated line every interval seconds instead of several per connection"""
+    previous = metrics.snapshot()
+    while not shutdown_flag.wait(interval):
+        current = metrics.snapshot()
+        accepted = metrics.total(current, "forwarder_connections_accepted_total") - \
+            metrics.total(previous, "forwarder_connections_accepted_total")
+        moved = {}
+        for (name, labels), value in current.items():
+            if name == "forwarder_bytes_total":
+                direction = dict(labels)["direction"]
+                moved[direction] = moved.get(direction, 0) + value - previous.get((name, labels), 0)
+        errors = metrics.total(current, "forwarder_errors_total") - metrics.total(previous, "forwarder_errors_total")
+        previous = current
+        if not (accepted or errors or any(moved.values()) or metrics.total(current, "forwarder_connections_active")):
+            continue  # Nothing to report while idle
+        logging.info(f"Summary: {metrics.total(current, 'forwarder_connections_active'):.0f} active, "
+                     f"{accepted:.0f} accepted ({accepted / interval:.1f}/s), "
+                     + ", ".join(f"{direction} {value / interval / 1e6:.2f} MB/s" for direction, value in sorted(moved.items()))
+                     + f", {errors:.0f} errors")
+
+COPY_STRATEGIES = ("recv", "recv_into", "splice")
+DEFAULT_COPY_STRATEGY = "recv_into"
+DEFAULT_BUFFER_SIZE = 64 * 1024
+
+class CopyPump:
+    """Moves bytes from source to destination through a fresh bytes object per recv().
+
+    All pumps share one interface: fill() reads once and returns the byte count
+    (0 at end of stream), drain() writes without blocking and raises
+    BlockingIOError when the destination is full, flush() writes everything.
+    """
+
+    def __init__(self, source, destination, buffer_size):
+        self.source = source
+        self.destination = destination
+        self.buffer_size = buffer_size
+        self.data = None
+        self.start = self.end = 0
+
+    @property
+    def pending(self):
+        return self.end - self.start
+
+    def fill(self):
+        self.data = memoryview(self.source.recv(self.buffer_size))
+        self.start, self.end = 0, len(self.data)
+        return self.end
+
+    def drain(self):
+        while self.start < self.end:
+            self.start += self.destination.send(self.data[self.start:self.end])
+        self.data = None
+
+    def flush(self):
+        while self.pending and not shutdown_flag.is_set():
+            try:
+                self.drain()
+            except (BlockingIOError, socket.timeout):
+                select.select([], [self.destination], [], 1.0)
+
+    def close(self):
+        self.data = None
+        self.start = self.end = 0
+
+class BufferPump(CopyPump):
+    """recv_into() a preallocated buffer and send() straight out of a memoryview.
+
+    In the event loop every connection shares one scratch buffer; a direction
+    only copies its unsent tail into private memory when the destination
+    blocks, so idle connections hold no buffer at all.
+    """
+
+    def __init__(self, source, destination, buffer_size, scratch=None):
+        super().__init__(source, destination, buffer_size)
+        self.scratch = scratch
+        self.buffer = None
+
+    def fill(self):
+        if self.scratch is not None:
+            view = self.scratch
+        else:
+            if self.buffer is None:
+                self.buffer = memoryview(bytearray(self.buffer_size))
+            view = self.buffer
+        self.start, self.end = 0, self.source.recv_into(view)
+        self.data = view
+        return self.end
+
+    def drain(self):
+        try:
+            super().drain()
+        except BlockingIOError:
+            if self.data is self.scratch:
+                self.data = memoryview(bytes(self.data[self.start:self.end]))
+                self.start, self.end = 0, len(self.data)
+            raise
+
+    def close(self):
+        super().close()
+        self.buffer = None
+
+# splice() errnos that mean "not for these file descriptors" rather than a failed connection
+SPLICE_UNSUPPORTED = (errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP)
+
+class SplicePump(CopyPump):
+    """Zero-copy socket->pipe->socket moves with os.splice().
+
+    Falls back to a BufferPump the first time the kernel or Python refuses
+    to splice, on either side of the pipe; whatever already sits in the pipe
+    is read back and sent by the BufferPump.
+    """
+
+    def __init__(self, source, destination, buffer_size, scratch=None):
+        super().__init__(source, destination, buffer_size)
+        self.fallback = None
+        self.pipe = None
+        if not hasattr(os, "splice"):
+            self.fallback = BufferPump(source, destination, buffer_size, scratch)
+            return
+        self.scratch = scratch
+        self.in_pipe = 0
+
+    @property
+    def pending(self):
+        if self.fallback:
+            return self.fallback.pending
+        return self.in_pipe
+
+    def _open_pipe(self):
+        self.pipe = os.pipe2(os.O_NONBLOCK | os.O_CLOEXEC)
+        if fcntl is not None and hasattr(fcntl, "F_SETPIPE_SZ"):
+            try:
+                fcntl.fcntl(self.pipe[1], fcntl.F_SETPIPE_SZ, self.buffer_size)
+            except OSError:
+                pass  # Above /proc/sys/fs/pipe-max-size; keep the default size
+
+    def fill(self):
+        if self.fallback:
+            return self.fallback.fill()
+        timeout = self.source.gettimeout()
+        if timeout:
+            # Threaded engine: emulate the socket timeout, splice itself never blocks
+            if not select.select([self.source], [], [], timeout)[0]:
+                raise socket.timeout("timed out")
+        if self.pipe is None:
+            self._open_pipe()
+        try:
+            self.in_pipe = os.splice(self.source.fileno(), self.pipe[1], self.buffer_size,
+                                     flags=os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK)
+        except OSError as e:
+            if e.errno not in SPLICE_UNSUPPORTED:
+                raise
+            logging.debug(f"splice unsupported for {self.source.family.name}: {e}, using recv_into")
+            self._close_pipe()
+            self.fallback = BufferPump(self.source, self.destination, self.buffer_size, self.scratch)
+            return self.fallback.fill()
+        return self.in_pipe
+
+    def drain(self):
+        if self.fallback:
+            return self.fallback.drain()
+        while self.in_pipe:
+            try:
+                self.in_pipe -= os.splice(self.pipe[0], self.destination.fileno(), self.in_pipe,
+                                          flags=os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK)
+            except OSError as e:
+                if e.errno not in SPLICE_UNSUPPORTED:
+                    raise
+                logging.debug(f"splice unsupported for {self.destination.family.name}: {e}, using send")
+                self._fall_back_with_pipe_contents()
+                return self.fallback.drain()
+
+    def _fall_back_with_pipe_contents(self):
+        data = bytearray()
+        while len(data) < self.in_pipe:
+            data += os.read(self.pipe[0], self.in_pipe - len(data))
+        self._close_pipe()
+        self.in_pipe = 0
+        self.fallback = BufferPump(self.source, self.destination, self.buffer_size, self.scratch)
+        self.fallback.data = memoryview(bytes(data))
+        self.fallback.start, self.fallback.end = 0, len(data)
+
+    def _close_pipe(self):
+        if self.pipe:
+            for fd in self.pipe:
+                os.close(fd)
+            self.pipe = None
+
+    def close(self):
+        if self.fallback:
+            self.fallback.close()
+            return
+        self._close_pipe()
+        self.in_pipe = 0
+
+def make_pump(source, destination, copy_strategy, buffer_size, scratch=None):
+    if copy_strategy == "recv":
+        return CopyPump(source, destination, buffer_size)
+    if copy_strategy == "splice":
+        return SplicePump(source, destination, buffer_size, scratch)
+    return BufferPump(source, destination, buffer_size, scratch)
+
+def forward(source, destination, connection_id, direction, route, connection=None):
+    """Forward data between sockets with proper cleanup; with timeouts enabled,
+    connection (a ThreadedConnection) records when data last moved"""
+    pump = make_pump(source, destination, route.copy_strategy, route.buffer_size)
+    fill = timed("forward_fill")(pump.fill)
+    flush = timed("forward_flush")(pump.flush)
+    relayed = metrics.key("forwarder_bytes_total", route=route.local, direction=direction)
     try:
         source.settimeout(1.0)  # 1 second timeout for checking shutdown
         while not shutdown_flag.is_set():
             try:
-                data = source.recv(1024)
-                if not data:
-                    logging.info(f"Connection {connection_id}: End of data stream ({direction})")
+                received = fill()
+                if not received:
+                    connection_log.info(f"Connection {connection_id}: End of data stream ({direction})")
                     break
-                destination.sendall(data)
-            except socket.timeout:
+                flush()
+                metrics.inc(relayed, received)
+                if connection is not None:
+                    connection.last_active = time.monotonic()
+            except (socket.timeout, BlockingIOError):
                 continue  # Check shutdown flag
             except OSError as e:
                 # Check if it's a bad file descriptor or transport endpoint error
                 if e.errno in (9, 107) or "Bad file descriptor" in str(e) or "Transport endpoint is not connected" in str(e):
                     # Socket was closed by the other thread, this is normal during shutdown
-                    logging.debug(f"Connection {connection_id}: Socket closed by peer ({direction})")
+                    connection_log.debug(f"Connection {connection_id}: Socket closed by peer ({direction})")
                 else:
-                    logging.error(f"Connection {connection_id}: Forwarding error ({direction}): {e}")
+                    count_error(route, e)
+                    connection_log.error(f"Connection {connection_id}: Forwarding error ({direction}): {e}")
                 break
             except Exception as e:
                 if not shutdown_flag.is_set():
-                    logging.error(f"Connection {connection_id}: Forwarding error ({direction}): {e}")
+                    count_error(route, e)
+                    connection_log.error(f"Connection {connection_id}: Forwarding error ({direction}): {e}")
                 break
     except Exception as e:
-        logging.error(f"Connection {connection_id}: Fatal error ({direction}): {e}")
+        connection_log.error(f"Connection {connection_id}: Fatal error ({direction}): {e}")
     finally:
+        pump.close()
         # Only shutdown our reading side and their writing side
         try:
             if direction == "client->server":
@@ -58,29 +324,532 @@ def forward(source, destination, connection_id, direction):
         except OSError:
             # Socket might already be closed, that's OK
             pass
-        logging.info(f"Connection {connection_id}: Completed ({direction})")
+        connection_log.info(f"Connection {connection_id}: Completed ({direction})")
+
+class VsockPool:
+    """Pre-established VSOCK connections to (remote_cid, remote_port), handed to
+    accepted clients so they skip the connect round trip.
+
+    A background thread keeps `target` idle connections ready. The target
+    starts at min_size and grows towards max_size on every miss, then decays
+    back once the pool has been idle for max_idle seconds. Connect failures
+    (e.g. the enclave restarting) back off exponentially up to max_backoff.
+    """
+
+    def __init__(self, remote_cid, remote_port, min_size, max_size, max_idle=60.0,
+                 connect_timeout=30, max_backoff=30.0, tune=None):
+        self.remote_cid = remote_cid
+        self.remote_port = remote_port
+        self.min_size = min_size
+        self.max_size = max_size
+        self.max_idle = max_idle
+        self.connect_timeout = connect_timeout
+        self.max_backoff = max_backoff
+        self.tune = tune  # Applies socket options before connecting
+        self.target = min_size
+        self.idle = collections.deque()  # (socket, connected_at), oldest first
+        self.cond = threading.Condition()
+        self.closed = False
+        self.thread = None
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.connect_failures = 0
+        self.last_miss = 0.0
+
+    def collect(self, route):
+        """Publish the pool counters into the metrics registry"""
+        stats = self.stats()
+        metrics.set(metrics.key("forwarder_pool_hits_total", route=route.local), stats["hits"])
+        metrics.set(metrics.key("forwarder_pool_misses_total", route=route.local), stats["misses"])
+        metrics.set(metrics.key("forwarder_pool_idle", route=route.local), stats["idle"])
 
-def handle_connection(client_socket, client_addr, remote_cid, remote_port, connection_id):
+    def start(self):
+        self.thread = threading.Thread(target=self._refill, name="vsock-pool", daemon=True)
+        self.thread.start()
+        logging.info(f"VSOCK pool to {self.remote_cid}:{self.remote_port} "
+                     f"(min {self.min_size}, max {self.max_size})")
+
+    def stats(self):
+        with self.cond:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "stale": self.stale,
+                "connect_failures": self.connect_failures,
+                "idle": len(self.idle),
+                "target": self.target,
+            }
+
+    @staticmethod
+    def _is_usable(sock):
+        """A pooled socket the enclave has since closed polls readable with EOF"""
+        try:
+            if not select.select([sock], [], [], 0)[0]:
+                return True
+            return bool(sock.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT))
+        except (OSError, ValueError):
+            return False
+
+    def acquire(self):
+        """Return a connected VSOCK socket, or None when the pool has none ready"""
+        now = time.monotonic()
+        with self.cond:
+            while self.idle:
+                sock, connected_at = self.idle.popleft()
+                if now - connected_at < self.max_idle and self._is_usable(sock):
+                    self.hits += 1
+                    self.cond.notify()
+                    return sock
+                self.stale += 1
+                sock.close()
+            self.misses += 1
+            self.last_miss = now
+            self.target = min(self.max_size, max(self.target, 1) * 2)
+            self.cond.notify()
+            return None
+
+    def _connect(self):
+        sock = socket.socket(socket.AF_VSOCK, socket.SOCK_STREAM)
+        try:
+            if self.tune:
+                self.tune(sock)
+            sock.settimeout(self.connect_timeout)
+            sock.connect((self.remote_cid, self.remote_port))
+        except OSError:
+            sock.close()
+            raise
+        return sock
+
+    def _refill(self):
+        backoff = 0.0
+        while True:
+            with self.cond:
+                while not self.closed and len(self.idle) >= self.target:
+                    self.cond.wait(self.max_idle)
+                    now = time.monotonic()
+                    # Drop connections the enclave may have timed out and shrink after quiet periods
+                    while self.idle and now - self.idle[0][1] >= self.max_idle:
+                        self.idle.popleft()[0].close()
+                        self.stale += 1
+                    if self.target > self.min_size and now - self.last_miss >= self.max_idle:
+                        self.target = max(self.min_size, self.target // 2)
+                if self.closed:
+                    return
+
+            try:
+                sock = self._connect()
+            except OSError as e:
+                with self.cond:
+                    self.connect_failures += 1
+                if not backoff:
+                    logging.warning(f"VSOCK pool: connect to {self.remote_cid}:{self.remote_port} failed ({e}), backing off")
+                backoff = min(self.max_backoff, backoff * 2 if backoff else 0.1)
+                with self.cond:
+                    self.cond.wait_for(lambda: self.closed, timeout=backoff)
+                continue
+
+            if backoff:
+                logging.info(f"VSOCK pool: {self.remote_cid}:{self.remote_port} reachable again")
+                backoff = 0.0
+            with self.cond:
+                if self.closed:
+                    sock.close()
+                    return
+                self.idle.append((sock, time.monotonic()))
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+            while self.idle:
+                self.idle.popleft()[0].close()
+        if self.thread:
+            self.thread.join(timeout=5)
+        logging.info(f"VSOCK pool stats: {self.stats()}")
+
+class Route:
+    """One <local_ip>:<local_port> -> <remote_cid>:<remote_port> mapping and how to serve it"""
+
+    OPTIONS = {
+        "engine": "threads",
+        "copy_strategy": DEFAULT_COPY_STRATEGY,
+        "buffer_size": DEFAULT_BUFFER_SIZE,
+        "pool_min": 0,
+        "pool_max": None,
+        "pool_max_idle": 60.0,
+        "workers": 1,
+        "backlog": socket.SOMAXCONN,
+        "max_connections": 0,
+        "max_connections_per_ip": 0,
+        "overload_policy": "reject",
+        "accept_queue": 128,
+        "queue_timeout": 5.0,
+        "idle_timeout": 0,
+        "max_lifetime": 0,
+        "tcp_nodelay": False,
+        "keepalive": False,
+        "keepalive_idle": 0,
+        "keepalive_interval": 0,
+        "keepalive_count": 0,
+        "tcp_sndbuf": 0,
+        "tcp_rcvbuf": 0,
+        "vsock_sndbuf": 0,
+        "vsock_rcvbuf": 0,
+    }
+
+    def __init__(self, local_ip, local_port, remote_cid, remote_port, **options):
+        unknown = set(options) - set(self.OPTIONS)
+        if unknown:
+            raise ValueError(f"Unknown route option(s): {', '.join(sorted(unknown))}")
+        self.local_ip = str(local_ip)
+        self.local_port = int(local_port)
+        self.remote_cid = int(remote_cid)
+        self.remote_port = int(remote_port)
+        for name, default in self.OPTIONS.items():
+            setattr(self, name, options.get(name, default))
+        if self.pool_max is None:
+            self.pool_max = self.pool_min
+        self.validate()
+
+    @classmethod
+    def from_dict(cls, entry, defaults=None):
+        options = dict(defaults or {})
+        options.update(entry)
+        try:
+            addresses = [options.pop(key) for key in ("local_ip", "local_port", "remote_cid", "remote_port")]
+        except KeyError as e:
+            raise ValueError(f"Route {entry} is missing {e}")
+        return cls(*addresses, **options)
+
+    @property
+    def local(self):
+        return f"{self.local_ip}:{self.local_port}"
+
+    @property
+    def remote(self):
+        return f"{self.remote_cid}:{self.remote_port}"
+
+    def validate(self):
+        if self.engine not in ("threads", "events"):
+            raise ValueError(f"{self.local}: engine must be 'threads' or 'events'")
+        if self.copy_strategy not in COPY_STRATEGIES:
+            raise ValueError(f"{self.local}: copy_strategy must be one of {', '.join(COPY_STRATEGIES)}")
+        if self.buffer_size < 1024:
+            raise ValueError(f"{self.local}: buffer_size must be at least 1024 bytes")
+        if self.pool_min < 0 or self.pool_max < self.pool_min:
+            raise ValueError(f"{self.local}: pool_max must be at least pool_min, and both non-negative")
+        if self.workers < 1 or self.backlog < 1:
+            raise ValueError(f"{self.local}: workers and backlog must be positive")
+        if self.max_connections < 0 or self.max_connections_per_ip < 0 or self.accept_queue < 0:
+            raise ValueError(f"{self.local}: connection limits and accept_queue must not be negative")
+        if self.idle_timeout < 0 or self.max_lifetime < 0:
+            raise ValueError(f"{self.local}: idle_timeout and max_lifetime must not be negative")
+        if min(self.keepalive_idle, self.keepalive_interval, self.keepalive_count) < 0:
+            raise ValueError(f"{self.local}: keepalive parameters must not be negative")
+        if min(self.tcp_sndbuf, self.tcp_rcvbuf, self.vsock_sndbuf, self.vsock_rcvbuf) < 0:
+            raise ValueError(f"{self.local}: socket buffer sizes must not be negative")
+        if self.overload_policy not in ("reject", "queue"):
+            raise ValueError(f"{self.local}: overload_policy must be 'reject' or 'queue'")
+        if self.workers > 1 and not hasattr(socket, "SO_REUSEPORT"):
+            raise ValueError(f"{self.local}: multiple workers need SO_REUSEPORT, which this platform lacks")
+
+def load_routes(path, defaults):
+    """Read a JSON file of the form {"defaults": {...}, "routes": [{...}, ...]}"""
+    with open(path) as f:
+        config = json.load(f)
+    defaults = dict(defaults)
+    defaults.update(config.get("defaults", {}))
+    routes = [Route.from_dict(entry, defaults) for entry in config.get("routes", [])]
+    if not routes:
+        raise ValueError(f"{path} declares no routes")
+    return routes
+
+# (route, option) pairs already warned about, so failures are logged once
+untunable = set()
+
+def tune_socket(sock, route, leg):
+    """Apply the route's options for its "tcp" or "vsock" leg. Buffer sizes
+    only fully apply before connect() or, for TCP, on the listening socket,
+    whose options accepted connections inherit."""
+    options = []
+    if leg == "tcp":
+        if route.tcp_nodelay:
+            options.append(("tcp_nodelay", socket.IPPROTO_TCP, socket.TCP_NODELAY, 1))
+        if route.keepalive:
+            options.append(("keepalive", socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1))
+            for name, constant in (("keepalive_idle", "TCP_KEEPIDLE"), ("keepalive_interval", "TCP_KEEPINTVL"),
+                                   ("keepalive_count", "TCP_KEEPCNT")):
+                if getattr(route, name) and hasattr(socket, constant):
+                    options.append((name, socket.IPPROTO_TCP, getattr(socket, constant), int(getattr(route, name))))
+    for name, option in ((f"{leg}_sndbuf", socket.SO_SNDBUF), (f"{leg}_rcvbuf", socket.SO_RCVBUF)):
+        if getattr(route, name):
+            options.append((name, socket.SOL_SOCKET, option, getattr(route, name)))
+    for name, level, option, value in options:
+        try:
+            sock.setsockopt(level, option, value)
+        except OSError as e:
+            if (route.local, name) not in untunable:
+                untunable.add((route.local, name))
+                logging.warning(f"{route.local}: cannot set {name} on the {leg} socket: {e}")
+
+def reject(client_socket):
+    """Close with an immediate RST so an overloaded forwarder neither holds the
+    socket in TIME_WAIT nor leaves the client waiting on a half-open connection"""
+    try:
+        client_socket.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack("ii", 1, 0))
+    except OSError:
+        pass
+    client_socket.close()
+
+class AdmissionControl:
+    """Concurrent connection limits for a route, global and per source IP.
+
+    offer() decides for every accepted client in O(1): admit it, reject it, or
+    (overload_policy "queue") park it in a bounded FIFO until a slot frees up
+    or queue_timeout expires. release() frees a slot and returns the queued
+    client that takes it over, if any. Per-IP counts include queued clients;
+    a client over its per-IP limit is always rejected, since waiting would
+    not make its share any fairer.
+    """
+
+    ADMITTED, QUEUED, REJECTED = "admitted", "queued", "rejected"
+
+    def __init__(self, route):
+        self.route = route
+        self.lock = threading.Lock()
+        self.active = 0
+        self.per_ip = collections.Counter()
+        self.waiting = collections.deque()  # (deadline, client_socket, client_addr, connection_id)
+        metrics.add_collector(self.collect)
+
+    def collect(self):
+        metrics.set(metrics.key("forwarder_accept_queue_depth", route=self.route.local), len(self.waiting))
+
+    def _rejected(self, client_socket, connection_id, reason):
+        metrics.inc(metrics.key("forwarder_connections_rejected_total", route=self.route.local, reason=reason))
+        connection_log.warning(f"Connection {connection_id}: Rejected ({reason})")
+        reject(client_socket)
+
+    def offer(self, client_socket, client_addr, connection_id):
+        route = self.route
+        ip = client_addr[0]
+        with self.lock:
+            if route.max_connections_per_ip and self.per_ip[ip] >= route.max_connections_per_ip:
+                reason = "per_ip_limit"
+            elif not route.max_connections or self.active < route.max_connections:
+                self.active += 1
+                self.per_ip[ip] += 1
+                return self.ADMITTED
+            elif route.overload_policy == "queue" and len(self.waiting) < route.accept_queue:
+                self.per_ip[ip] += 1
+                self.waiting.append((time.monotonic() + route.queue_timeout, client_socket, client_addr, connection_id))
+                return self.QUEUED
+            else:
+                reason = "queue_full" if route.overload_policy == "queue" else "limit"
+        self._rejected(client_socket, connection_id, reason)
+        return self.REJECTED
+
+    def release(self, client_addr):
+        """Free the slot held by client_addr; returns (client_socket, client_addr,
+        connection_id) of the queued client now admitted into it, or None.
+        Queued clients whose queue_timeout has passed are rejected, not admitted."""
+        with self.lock:
+            ip = client_addr[0]
+            self.per_ip[ip] -= 1
+            if not self.per_ip[ip]:
+                del self.per_ip[ip]
+            expired = self._pop_expired()
+            if self.waiting:
+                admitted = self.waiting.popleft()[1:]
+            else:
+                admitted = None
+                self.active -= 1
+        self._reject_expired(expired)
+        return admitted
+
+    def next_deadline(self):
+        with self.lock:
+            return self.waiting[0][0] if self.waiting else None
+
+    def _pop_expired(self):
+        """Remove queued clients past their deadline; the queue is in deadline order. Call with the lock held."""
+        now = time.monotonic()
+        expired = []
+        while self.waiting and self.waiting[0][0] <= now:
+            _, client_socket, client_addr, connection_id = self.waiting.popleft()
+            self.per_ip[client_addr[0]] -= 1
+            if not self.per_ip[client_addr[0]]:
+                del self.per_ip[client_addr[0]]
+            expired.append((client_socket, connection_id))
+        return expired
+
+    def _reject_expired(self, expired):
+        for client_socket, connection_id in expired:
+            self._rejected(client_socket, connection_id, "queue_timeout")
+
+    def expire(self):
+        """Reject queued clients whose wait exceeded queue_timeout"""
+        with self.lock:
+            expired = self._pop_expired()
+        self._reject_expired(expired)
+
+    def close(self):
+        with self.lock:
+            waiting, self.waiting = self.waiting, collections.deque()
+        for _, client_socket, _, _ in waiting:
+            reject(client_socket)
+
+class ConnectionTimeouts:
+    """Idle and lifetime deadlines for a route's connections, kept in one heap.
+
+    Connections only record when data last moved (last_active); nothing is
+    updated in the heap on traffic. When an idle entry comes due for a
+    connection that has been active since, it is pushed back with its new
+    deadline, so each connection costs O(log n) per idle_timeout period and
+    the caller only needs to wake up for next_deadline(). Entries of
+    connections that closed are counted by discard() and dropped all at
+    once when they outnumber the live ones, so the heap stays within twice
+    the size it needs.
+    """
+
+    def __init__(self, route):
+        self.route = route
+        self.idle_timeout = route.idle_timeout
+        self.max_lifetime = route.max_lifetime
+        self.heap = []  # (deadline, sequence, reason, connection)
+        self.sequence = itertools.count()
+        self.stale = 0  # entries of closed connections still in the heap
+        self.cond = threading.Condition()
+
+    @property
+    def enabled(self):
+        return bool(self.idle_timeout or self.max_lifetime)
+
+    def _push(self, deadline, reason, connection):
+        heapq.heappush(self.heap, (deadline, next(self.sequence), reason, connection))
+        if self.heap[0][3] is connection:
+            self.cond.notify()
+
+    def add(self, connection):
+        """Track connection, which needs closed, accepted_at and last_active attributes"""
+        with self.cond:
+            if self.idle_timeout:
+                self._push(connection.last_active + self.idle_timeout, "idle", connection)
+            if self.max_lifetime:
+                self._push(connection.accepted_at + self.max_lifetime, "lifetime", connection)
+
+    def next_deadline(self):
+        if not self.heap:
+            return None
+        with self.cond:
+            return self.heap[0][0] if self.heap else None
+
+    def expired(self):
+        """Pop the entries that are due and return [(connection, reason)] for
+        the open connections that really did time out"""
+        now = time.monotonic()
+        due = []
+        with self.cond:
+            while self.heap and self.heap[0][0] <= now:
+                _, _, reason, connection = heapq.heappop(self.heap)
+                if connection.closed:
+                    self.stale = max(0, self.stale - 1)
+                    continue
+                if reason == "idle" and connection.last_active + self.idle_timeout > now:
+                    self._push(connection.last_active + self.idle_timeout, "idle", connection)
+                    continue
+                due.append((connection, reason))
+        for connection, reason in due:
+            metrics.inc(metrics.key("forwarder_connections_timed_out_total", route=self.route.local, reason=reason))
+            limit = "idle timeout" if reason == "idle" else "max lifetime"
+            connection_log.warning(f"Connection {connection.connection_id}: Shutting down, {limit} reached")
+        return due
+
+    def discard(self, connection):
+        """Count the entries of connection, which has closed, as stale and
+        rebuild the heap without them once they are the majority"""
+        with self.cond:
+            self.stale += bool(self.idle_timeout) + bool(self.max_lifetime)
+            if self.stale * 2 > len(self.heap):
+                self.heap = [entry for entry in self.heap if not entry[3].closed]
+                heapq.heapify(self.heap)
+                self.stale = 0
+
+    def wait(self, timeout):
+        """Sleep until the next deadline, a new earlier one, or timeout"""
+        with self.cond:
+            if self.heap:
+                timeout = min(timeout, max(0.0, self.heap[0][0] - time.monotonic()))
+            self.cond.wait(timeout)
+
+    def reap(self):
+        """Threads engine: shut down timed-out connections until shutdown"""
+        while not shutdown_flag.is_set():
+            for connection, _ in self.expired():
+                connection.shutdown()
+            self.wait(1.0)
+
+def shutdown_both(*sockets):
+    """Shut down both directions so each peer sees end of stream and any thread
+    blocked on the socket wakes up"""
+    for sock in sockets:
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+class ThreadedConnection:
+    """What ConnectionTimeouts needs from a connection of the threads engine"""
+
+    def __init__(self, connection_id, accepted_at):
+        self.connection_id = connection_id
+        self.accepted_at = self.last_active = accepted_at
+        self.sockets = ()
+        self.closed = False
+
+    def shutdown(self):
+        shutdown_both(*self.sockets)
+
+def handle_connection(client_socket, client_addr, route, connection_id, pool=None, timeouts=None):
     """Handle a single connection with proper resource management"""
     server_socket = None
     threads = []
+    accepted_at = time.monotonic()
+    connection = None
+    tune_socket(client_socket, route, "tcp")
+    active = metrics.key("forwarder_connections_active", route=route.local)
+    metrics.inc(active)
     
     try:
-        # Connect to VSOCK
-        server_socket = socket.socket(socket.AF_VSOCK, socket.SOCK_STREAM)
-        server_socket.settimeout(30)  # 30 second timeout for connection
-        server_socket.connect((remote_cid, remote_port))
-        logging.info(f"Connection {connection_id}: Connected to VSOCK {remote_cid}:{remote_port}")
+        server_socket = pool.acquire() if pool else None
+        if server_socket:
+            connection_log.info(f"Connection {connection_id}: Using pooled VSOCK {route.remote}")
+        else:
+            # Connect to VSOCK
+            server_socket = socket.socket(socket.AF_VSOCK, socket.SOCK_STREAM)
+            tune_socket(server_socket, route, "vsock")
+            server_socket.settimeout(30)  # 30 second timeout for connection
+            connect_start = time.monotonic()
+            server_socket.connect((route.remote_cid, route.remote_port))
+            metrics.observe(metrics.key("forwarder_vsock_connect_seconds", route=route.local),
+                            time.monotonic() - connect_start)
+            connection_log.info(f"Connection {connection_id}: Connected to VSOCK {route.remote}")
+
+        if timeouts:
+            connection = ThreadedConnection(connection_id, accepted_at)
+            connection.sockets = (client_socket, server_socket)
+            timeouts.add(connection)
         
         # Create forwarding threads
         outgoing_thread = threading.Thread(
             target=forward, 
-            args=(client_socket, server_socket, connection_id, "client->server"),
+            args=(client_socket, server_socket, connection_id, "client->server", route, connection),
             name=f"forward-{connection_id}-out"
         )
         incoming_thread = threading.Thread(
             target=forward, 
-            args=(server_socket, client_socket, connection_id, "server->client"),
+            args=(server_socket, client_socket, connection_id, "server->client", route, connection),
             name=f"forward-{connection_id}-in"
         )
         
@@ -95,8 +864,12 @@ def handle_connection(client_socket, client_addr, remote_cid, remote_port, conne
             thread.join()
             
     except Exception as e:
-        logging.error(f"Connection {connection_id}: Failed to establish connection: {e}")
+        count_error(route, e)
+        connection_log.error(f"Connection {connection_id}: Failed to establish connection: {e}")
     finally:
+        if connection:
+            connection.closed = True
+            timeouts.discard(connection)
         # Now that both forwarding threads are done, we can fully close the sockets
         for sock in [client_socket, server_socket]:
             if sock:
@@ -106,41 +879,406 @@ def handle_connection(client_socket, client_addr, remote_cid, remote_port, conne
                 except OSError:
                     pass  # Already closed
         
-        logging.info(f"Connection {connection_id}: Handler complete")
+        metrics.inc(active, -1)
+        metrics.observe(metrics.key("forwarder_connection_duration_seconds", route=route.local),
+                        time.monotonic() - accepted_at)
+        connection_log.info(f"Connection {connection_id}: Handler complete")
+
+class RelayConnection:
+    """A TCP<->VSOCK pair relayed by the event loop without its own threads"""
+
+    def __init__(self, connection_id, client_socket, client_addr, server_socket, route, make_pump, connecting=True):
+        self.connection_id = connection_id
+        self.client_addr = client_addr
+        self.route = route
+        self.accepted_at = self.connect_start = self.last_active = time.monotonic()
+        self.active = metrics.key("forwarder_connections_active", route=route.local)
+        metrics.inc(self.active)
+        self.client_socket = client_socket
+        self.server_socket = server_socket
+        self.connecting = connecting
+        self.closed = False
+        self.outgoing = RelayDirection(self, make_pump(client_socket, server_socket), "client->server")
+        self.incoming = RelayDirection(self, make_pump(server_socket, client_socket), "server->client")
+        self.masks = {client_socket: 0, server_socket: 0}
+
+    @property
+    def done(self):
+        return self.outgoing.done and self.incoming.done
+
+    def reading_from(self, sock):
+        return self.outgoing if sock is self.client_socket else self.incoming
+
+    def writing_to(self, sock):
+        return self.incoming if sock is self.client_socket else self.outgoing
+
+    def finish_connect(self):
+        """Complete the non-blocking VSOCK connect, returns False if it failed"""
+        self.connecting = False
+        err = self.server_socket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err:
+            count_error(self.route, OSError(err, os.strerror(err)))
+            connection_log.error(f"Connection {self.connection_id}: Failed to establish connection: {os.strerror(err)}")
+            self.outgoing.done = self.incoming.done = True
+            return False
+        metrics.observe(metrics.key("forwarder_vsock_connect_seconds", route=self.route.local),
+                        time.monotonic() - self.connect_start)
+        connection_log.info(f"Connection {self.connection_id}: Connected to VSOCK {self.route.remote}")
+        return True
+
+    def handle_event(self, sock, mask):
+        if self.connecting:
+            if sock is self.server_socket and mask & selectors.EVENT_WRITE:
+                self.finish_connect()
+            return
+        if mask & selectors.EVENT_READ:
+            self.reading_from(sock).on_readable()
+        if mask & selectors.EVENT_WRITE:
+            self.writing_to(sock).on_writable()
+
+    def wanted_mask(self, sock):
+        if self.connecting:
+            return selectors.EVENT_WRITE if sock is self.server_socket else 0
+        mask = 0
+        if self.reading_from(sock).wants_read():
+            mask |= selectors.EVENT_READ
+        if self.writing_to(sock).wants_write():
+            mask |= selectors.EVENT_WRITE
+        return mask
+
+    def update_interest(self, selector):
+        """Re-register both sockets with the events they are currently waiting for"""
+        for sock, current in self.masks.items():
+            mask = 0 if self.done else self.wanted_mask(sock)
+            if mask == current:
+                continue
+            if current == 0:
+                selector.register(sock, mask, self)
+            elif mask == 0:
+                selector.unregister(sock)
+            else:
+                selector.modify(sock, mask, self)
+            self.masks[sock] = mask
+
+    def shutdown(self):
+        shutdown_both(self.client_socket, self.server_socket)
+
+    def close(self, selector):
+        if self.closed:
+            return
+        self.closed = True
+        for direction in (self.outgoing, self.incoming):
+            direction.pump.close()
+        for sock, current in self.masks.items():
+            if current:
+                selector.unregister(sock)
+            try:
+                sock.close()
+            except OSError:
+                pass
+        metrics.inc(self.active, -1)
+        metrics.observe(metrics.key("forwarder_connection_duration_seconds", route=self.route.local),
+                        time.monotonic() - self.accepted_at)
+        connection_log.info(f"Connection {self.connection_id}: Handler complete")
+
+
+class RelayDirection:
+    """One direction of a RelayConnection, mirroring a forward() thread"""
+
+    def __init__(self, connection, pump, direction):
+        self.connection = connection
+        self.pump = pump
+        self.source = pump.source
+        self.destination = pump.destination
+        self.fill = timed("forward_fill")(pump.fill)
+        self.drain = timed("forward_drain")(pump.drain)
+        self.direction = direction
+        self.relayed = metrics.key("forwarder_bytes_total", route=connection.route.local, direction=direction)
+        self.eof = False
+        self.done = False
+
+    def wants_read(self):
+        # Stop reading while the destination is backed up so the kernel
+        # buffers (and TCP/VSOCK flow control) apply backpressure
+        return not self.done and not self.eof and not self.pump.pending
+
+    def wants_write(self):
+        return not self.done and self.pump.pending > 0
+
+    def on_readable(self):
+        try:
+            received = self.fill()
+        except BlockingIOError:
+            return
+        except OSError as e:
+            self.fail(e)
+            return
+        if not received:
+            connection_log.info(f"Connection {self.connection.connection_id}: End of data stream ({self.direction})")
+            self.eof = True
+        else:
+            metrics.inc(self.relayed, received)
+        self.on_writable()
+
+    def on_writable(self):
+        if self.pump.pending:
+            try:
+                self.drain()
+            except BlockingIOError:
+                return
+            except OSError as e:
+                self.fail(e)
+                return
+        if self.eof and not self.pump.pending:
+            self.finish()
+
+    def fail(self, e):
+        if e.errno in (errno.EBADF, errno.ENOTCONN):
+            connection_log.debug(f"Connection {self.connection.connection_id}: Socket closed by peer ({self.direction})")
+        else:
+            count_error(self.connection.route, e)
+            connection_log.error(f"Connection {self.connection.connection_id}: Forwarding error ({self.direction}): {e}")
+        self.finish()
+
+    def finish(self):
+        # Same half-close as forward(): stop reading our source, stop writing the destination
+        self.done = True
+        self.pump.close()
+        for sock, how in ((self.source, socket.SHUT_RD), (self.destination, socket.SHUT_WR)):
+            try:
+                sock.shutdown(how)
+            except OSError:
+                pass
+        connection_log.info(f"Connection {self.connection.connection_id}: Completed ({self.direction})")
+
+
+def open_vsock_nonblocking(route):
+    """Start a VSOCK connect without blocking; completion is reported as writability.
+    The kernel bounds how long a VSOCK connect can stay pending."""
+    remote_cid, remote_port = route.remote_cid, route.remote_port
+    server_socket = socket.socket(socket.AF_VSOCK, socket.SOCK_STREAM)
+    tune_socket(server_socket, route, "vsock")
+    server_socket.setblocking(False)
+    err = server_socket.connect_ex((remote_cid, remote_port))
+    if err not in (0, errno.EINPROGRESS, errno.EAGAIN):
+        server_socket.close()
+        raise OSError(err, os.strerror(err))
+    return server_socket
+
+def open_listener(route):
+    """Bind the route's TCP listener. With several workers every process binds
+    its own SO_REUSEPORT socket and the kernel spreads connections across them."""
+    dock_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        dock_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if route.workers > 1:
+            dock_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        tune_socket(dock_socket, route, "tcp")
+        dock_socket.bind((route.local_ip, route.local_port))
+        dock_socket.listen(route.backlog)
+    except OSError:
+        dock_socket.close()
+        raise
+    return dock_socket
+
+def event_server(route, pool=None):
+    """Relay every connection on a single selector loop: no per-connection threads
+    and no polling timeouts. Signals wake the loop through a wakeup fd."""
+    selector = selectors.DefaultSelector()
+    # Only one direction runs at a time, so they can all read into the same buffer
+    scratch = memoryview(bytearray(route.buffer_size))
+    def pump_factory(source, destination):
+        return make_pump(source, destination, route.copy_strategy, route.buffer_size, scratch)
+
+    dock_socket = None
+    wakeup_r, wakeup_w = socket.socketpair()
+    previous_wakeup_fd = None
+    connection_counter = 0
+    active_connections = set()
+    accepted = metrics.key("forwarder_connections_accepted_total", route=route.local)
+    admission = AdmissionControl(route)
+    timeouts = ConnectionTimeouts(route)
+
+    def start_relay(client_socket, client_addr, connection_id):
+        """Pair an admitted client with a VSOCK connection; returns False if that failed"""
+        tune_socket(client_socket, route, "tcp")
+        client_socket.setblocking(False)
+        server_socket = pool.acquire() if pool else None
+        pooled = server_socket is not None
+        if pooled:
+            server_socket.setblocking(False)
+            connection_log.info(f"Connection {connection_id}: Using pooled VSOCK {route.remote}")
+        else:
+            try:
+                server_socket = open_vsock_nonblocking(route)
+            except OSError as e:
+                count_error(route, e)
+                connection_log.error(f"Connection {connection_id}: Failed to establish connection: {e}")
+                client_socket.close()
+                connection_log.info(f"Connection {connection_id}: Handler complete")
+                return False
+        connection = RelayConnection(connection_id, client_socket, client_addr, server_socket,
+                                     route, pump_factory, connecting=not pooled)
+        active_connections.add(connection)
+        connection.update_interest(selector)
+        if timeouts.enabled:
+            timeouts.add(connection)
+        return True
+
+    def finished(client_addr):
+        # Hand the freed slot to queued clients until one of them starts relaying
+        queued = admission.release(client_addr)
+        while queued and not start_relay(*queued):
+            queued = admission.release(queued[1])
+
+    try:
+        for sock in (wakeup_r, wakeup_w):
+            sock.setblocking(False)
+        previous_wakeup_fd = signal.set_wakeup_fd(wakeup_w.fileno())
+        selector.register(wakeup_r, selectors.EVENT_READ, None)
+
+        dock_socket = open_listener(route)
+        dock_socket.setblocking(False)
+        selector.register(dock_socket, selectors.EVENT_READ, None)
+        logging.info(f"Listening on {route.local} (event loop)")
+
+        while not shutdown_flag.is_set():
+            # Only wake up for queued clients and connection timeouts that are due
+            deadlines = [deadline for deadline in (admission.next_deadline(), timeouts.next_deadline())
+                         if deadline is not None]
+            timeout = max(0.0, min(deadlines) - time.monotonic()) if deadlines else None
+            events = selector.select(timeout)
+            now = time.monotonic()
+            for key, mask in events:
+                if key.fileobj is wakeup_r:
+                    try:
+                        while wakeup_r.recv(512):
+                            pass
+                    except BlockingIOError:
+                        pass
+                    continue
+
+                if key.fileobj is dock_socket:
+                    while True:
+                        try:
+                            client_socket, client_addr = dock_socket.accept()
+                        except BlockingIOError:
+                            break
+                        except OSError as e:
+                            logging.error(f"Server error: {e}")
+                            break
+                        connection_counter += 1
+                        connection_id = f"{connection_counter}"
+                        metrics.inc(accepted)
+                        connection_log.info(f"Connection {connection_id}: Accepted from {client_addr}")
+                        if admission.offer(client_socket, client_addr, connection_id) != AdmissionControl.ADMITTED:
+                            continue
+                        if not start_relay(client_socket, client_addr, connection_id):
+                            finished(client_addr)
+                    continue
 
-def server(local_ip, local_port, remote_cid, remote_port):
+                connection = key.data
+                if connection.closed:
+                    continue
+                connection.last_active = now
+                connection.handle_event(key.fileobj, mask)
+                if connection.done:
+                    connection.close(selector)
+                    active_connections.discard(connection)
+                    if timeouts.enabled:
+                        timeouts.discard(connection)
+                    finished(connection.client_addr)
+                else:
+                    connection.update_interest(selector)
+            admission.expire()
+            if timeouts.enabled:
+                for connection, _ in timeouts.expired():
+                    connection.shutdown()
+                    connection.close(selector)
+                    active_connections.discard(connection)
+                    timeouts.discard(connection)
+                    finished(connection.client_addr)
+
+    except Exception as e:
+        logging.error(f"Failed to start server: {e}")
+    finally:
+        if dock_socket:
+            try:
+                dock_socket.close()
+            except OSError:
+                pass
+
+        # The forwarding threads stop within a second of shutdown; do the same here
+        logging.info("Closing active connections...")
+        admission.close()
+        for connection in list(active_connections):
+            connection.close(selector)
+        active_connections.clear()
+
+        if previous_wakeup_fd is not None:
+            signal.set_wakeup_fd(previous_wakeup_fd)
+        for sock in (wakeup_r, wakeup_w):
+            sock.close()
+        selector.close()
+
+        logging.info("Server shutdown complete")
+
+def server(route, pool=None):
     """Main server with proper resource management and graceful shutdown"""
     dock_socket = None
     connection_counter = 0
-    active_connections = []
+    active_connections = set()
+    active_lock = threading.Lock()
+    accepted = metrics.key("forwarder_connections_accepted_total", route=route.local)
+    admission = AdmissionControl(route)
+    timeouts = ConnectionTimeouts(route)
+    if timeouts.enabled:
+        threading.Thread(target=timeouts.reap, name="connection-reaper", daemon=True).start()
+
+    def run_handler(client_socket, client_addr, connection_id):
+        # A freed slot goes straight to the next queued client on this same thread,
+        # so the number of handler threads never exceeds max_connections
+        try:
+            while True:
+                handle_connection(client_socket, client_addr, route, connection_id, pool,
+                                  timeouts if timeouts.enabled else None)
+                queued = admission.release(client_addr)
+                if not queued:
+                    break
+                if shutdown_flag.is_set():
+                    reject(queued[0])
+                    break
+                client_socket, client_addr, connection_id = queued
+        finally:
+            with active_lock:
+                active_connections.discard(threading.current_thread())
     
     try:
-        dock_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        dock_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        dock_socket.bind((local_ip, local_port))
-        dock_socket.listen(5)
+        dock_socket = open_listener(route)
         dock_socket.settimeout(1.0)  # Check for shutdown every second
-        logging.info(f"Listening on {local_ip}:{local_port}")
+        logging.info(f"Listening on {route.local}")
         
         while not shutdown_flag.is_set():
             try:
+                admission.expire()
                 client_socket, client_addr = dock_socket.accept()
                 connection_counter += 1
                 connection_id = f"{connection_counter}"
-                logging.info(f"Connection {connection_id}: Accepted from {client_addr}")
+                metrics.inc(accepted)
+                connection_log.info(f"Connection {connection_id}: Accepted from {client_addr}")
+                if admission.offer(client_socket, client_addr, connection_id) != AdmissionControl.ADMITTED:
+                    continue
                 
                 # Handle connection in a separate thread
                 handler_thread = threading.Thread(
-                    target=handle_connection,
-                    args=(client_socket, client_addr, remote_cid, remote_port, connection_id),
+                    target=run_handler,
+                    args=(client_socket, client_addr, connection_id),
                     name=f"handler-{connection_id}"
                 )
                 handler_thread.daemon = True  # Allow main thread to exit
+                with active_lock:
+                    active_connections.add(handler_thread)
                 handler_thread.start()
-                active_connections.append(handler_thread)
-                
-                # Clean up finished threads
-                active_connections = [t for t in active_connections if t.is_alive()]
                 
             except socket.timeout:
                 continue  # Check shutdown flag
@@ -156,29 +1294,232 @@ def server(local_ip, local_port, remote_cid, remote_port):
                 dock_socket.close()
             except:
                 pass
+        admission.close()
         
         # Wait for active connections to finish
         logging.info("Waiting for active connections to close...")
-        for thread in active_connections:
+        with active_lock:
+            remaining = list(active_connections)
+        for thread in remaining:
             thread.join(timeout=5)
         
         logging.info("Server shutdown complete")
 
+def publish_metrics(queue, interval=1.0):
+    """Send this worker's metrics to the supervisor until shutdown"""
+    name = multiprocessing.current_process().name
+    while not shutdown_flag.wait(interval):
+        queue.put((name, metrics.snapshot()))
+    queue.put((name, metrics.snapshot()))
+
+def run_route(route, summary_interval=0, metrics_queue=None):
+    """Serve one route in this process until shutdown"""
+    setup_instrumentation("traffic_forwarder")
+    if route.copy_strategy == "splice" and not hasattr(os, "splice"):
+        logging.warning("os.splice is not available on this Python, falling back to recv_into")
+
+    if summary_interval:
+        connection_log.setLevel(logging.WARNING)
+        threading.Thread(target=log_summaries, args=(summary_interval,), name="summaries", daemon=True).start()
+    if metrics_queue is not None:
+        threading.Thread(target=publish_metrics, args=(metrics_queue,), name="metrics-publisher", daemon=True).start()
+
+    pool = None
+    if route.pool_max:
+        pool = VsockPool(route.remote_cid, route.remote_port, route.pool_min, route.pool_max,
+                         max_idle=route.pool_max_idle, tune=lambda sock: tune_socket(sock, route, "vsock"))
+        metrics.add_collector(lambda: pool.collect(route))
+        pool.start()
+
+    serve = event_server if route.engine == "events" else server
+    try:
+        serve(route, pool)
+    finally:
+        if pool:
+            pool.close()
+
+class WorkerMetrics:
+    """Supervisor-side view of the workers' metrics: the latest snapshot from each
+    live worker plus the counters of workers that have since been replaced"""
+
+    def __init__(self):
+        self.queue = multiprocessing.Queue()
+        self.lock = threading.Lock()
+        self.latest = {}
+        self.retired = {}
+
+    def start(self):
+        threading.Thread(target=self._collect, name="metrics-collector", daemon=True).start()
+
+    def _collect(self):
+        while True:
+            name, snapshot = self.queue.get()
+            with self.lock:
+                self.latest[name] = snapshot
+
+    def retire(self, name):
+        with self.lock:
+            self.retired = metrics.merge([self.retired, self.latest.pop(name, {})], gauges=False)
+
+    def render(self):
+        with self.lock:
+            snapshots = [self.retired] + list(self.latest.values())
+        return metrics.render(metrics.merge(snapshots))
+
+def start_worker(route, index, options, worker_metrics=None):
+    worker = multiprocessing.Process(target=run_route,
+                                     args=(route, options.log_summary_interval,
+                                           worker_metrics.queue if worker_metrics else None),
+                                     name=f"{route.local}#{index}")
+    worker.start()
+    return worker
+
+# A worker that stayed up this long restarts with the shortest backoff again
+WORKER_STABLE_SECONDS = 30
+
+def supervise(routes, options):
+    """Run every route's workers as child processes and restart any that die.
+    Shutdown signals are passed on to the workers, which drain like a single process."""
+    for handler in logging.getLogger().handlers:
+        handler.setFormatter(logging.Formatter('%(asctime)s - %(processName)s - %(levelname)s - %(message)s'))
+
+    worker_metrics = None
+    if options.metrics_port:
+        worker_metrics = WorkerMetrics()
+        worker_metrics.start()
+        serve_metrics(options.metrics_host, options.metrics_port, worker_metrics.render)
+
+    slots = {}  # (route, index) -> [process, restart backoff, start time]
+    for route in routes:
+        logging.info(f"Route {route.local} -> {route.remote}: {route.workers} {route.engine} worker(s), "
+                     f"backlog {route.backlog}")
+        for index in range(route.workers):
+            slots[(route, index)] = [start_worker(route, index, options, worker_metrics), 0.0, time.monotonic()]
+
+    while not shutdown_flag.is_set():
+        multiprocessing.connection.wait([worker.sentinel for worker, _, _ in slots.values()], timeout=1.0)
+        for (route, index), slot in slots.items():
+            worker, backoff, started = slot
+            if worker.is_alive() or shutdown_flag.is_set():
+                continue
+            if time.monotonic() - started >= WORKER_STABLE_SECONDS:
+                backoff = 0.0
+            # Back off so a route that cannot bind does not spin
+            backoff = min(30.0, backoff * 2 if backoff else 0.5)
+            logging.error(f"Worker {worker.name} exited with {worker.exitcode}, restarting in {backoff:.1f}s")
+            if shutdown_flag.wait(backoff):
+                break
+            if worker_metrics:
+                worker_metrics.retire(worker.name)
+            slot[:] = [start_worker(route, index, options, worker_metrics), backoff, time.monotonic()]
+
+    logging.info("Stopping workers...")
+    for worker, _, _ in slots.values():
+        if worker.is_alive():
+            worker.terminate()  # SIGTERM -> the worker's own graceful shutdown
+    for worker, _, _ in slots.values():
+        worker.join(timeout=10)
+        if worker.is_alive():
+            logging.warning(f"Worker {worker.name} did not stop, killing it")
+            worker.kill()
+            worker.join()
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(description="Forward TCP connections to a VSOCK endpoint")
+    parser.add_argument("local_ip", nargs="?", help="Address to listen on")
+    parser.add_argument("local_port", nargs="?", type=int, help="TCP port to listen on")
+    parser.add_argument("remote_cid", nargs="?", type=int, help="VSOCK CID to forward to")
+    parser.add_argument("remote_port", nargs="?", type=int, help="VSOCK port to forward to")
+    parser.add_argument("--config",
+                        help="JSON file declaring many routes instead of the positional arguments; "
+                             "the options below become defaults for its routes")
+    parser.add_argument("--engine", choices=["threads", "events"], default="threads",
+                        help="threads: one handler and two forwarding threads per connection; "
+                             "events: every connection on a single selector loop (default: threads)")
+    parser.add_argument("--copy-strategy", choices=COPY_STRATEGIES, default=DEFAULT_COPY_STRATEGY,
+                        help="recv: new bytes object per read; recv_into: reusable preallocated buffers; "
+                             "splice: kernel socket->pipe->socket moves, falling back to recv_into "
+                             f"where unsupported (default: {DEFAULT_COPY_STRATEGY})")
+    parser.add_argument("--buffer-size", type=int, default=DEFAULT_BUFFER_SIZE,
+                        help=f"Bytes moved per read, 64-256 KiB suits bulk transfers (default: {DEFAULT_BUFFER_SIZE})")
+    parser.add_argument("--pool-min", type=int, default=0,
+                        help="Idle pre-connected VSOCK connections to keep ready (default: 0, no pool)")
+    parser.add_argument("--pool-max", type=int, default=None,
+                        help="Upper bound the pool grows to after misses (default: --pool-min)")
+    parser.add_argument("--pool-max-idle", type=float, default=60.0,
+                        help="Seconds a pooled connection may sit unused before it is replaced (default: 60)")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Processes sharing the listening port through SO_REUSEPORT (default: 1)")
+    parser.add_argument("--backlog", type=int, default=socket.SOMAXCONN,
+                        help=f"Listen backlog per worker (default: {socket.SOMAXCONN})")
+    parser.add_argument("--max-connections", type=int, default=0,
+                        help="Concurrent connections per worker before the overload policy applies (default: 0, unlimited)")
+    parser.add_argument("--max-connections-per-ip", type=int, default=0,
+                        help="Concurrent (and queued) connections per client IP; excess is rejected (default: 0, unlimited)")
+    parser.add_argument("--overload-policy", choices=["reject", "queue"], default="reject",
+                        help="At --max-connections, reset new clients immediately or queue them (default: reject)")
+    parser.add_argument("--accept-queue", type=int, default=128,
+                        help="Clients that may wait for a slot under the queue policy (default: 128)")
+    parser.add_argument("--queue-timeout", type=float, default=5.0,
+                        help="Seconds a queued client waits for a slot before it is reset (default: 5)")
+    parser.add_argument("--idle-timeout", type=float, default=0,
+                        help="Shut down connections that relayed nothing for this many seconds (default: 0, never)")
+    parser.add_argument("--max-lifetime", type=float, default=0,
+                        help="Shut down connections this many seconds after accept (default: 0, never)")
+    parser.add_argument("--tcp-nodelay", action="store_true",
+                        help="Disable Nagle's algorithm on client connections, for latency-sensitive routes")
+    parser.add_argument("--keepalive", action="store_true",
+                        help="Enable TCP keepalive on client connections so dead peers are detected")
+    parser.add_argument("--keepalive-idle", type=int, default=0,
+                        help="Seconds of silence before the first keepalive probe (default: 0, system setting)")
+    parser.add_argument("--keepalive-interval", type=int, default=0,
+                        help="Seconds between keepalive probes (default: 0, system setting)")
+    parser.add_argument("--keepalive-count", type=int, default=0,
+                        help="Unanswered probes before the connection is dropped (default: 0, system setting)")
+    parser.add_argument("--tcp-sndbuf", type=int, default=0,
+                        help="SO_SNDBUF for client connections in bytes (default: 0, system setting)")
+    parser.add_argument("--tcp-rcvbuf", type=int, default=0,
+                        help="SO_RCVBUF for client connections in bytes (default: 0, system setting)")
+    parser.add_argument("--vsock-sndbuf", type=int, default=0,
+                        help="SO_SNDBUF for VSOCK connections in bytes (default: 0, system setting)")
+    parser.add_argument("--vsock-rcvbuf", type=int, default=0,
+                        help="SO_RCVBUF for VSOCK connections in bytes (default: 0, system setting)")
+    parser.add_argument("--metrics-port", type=int, default=None,
+                        help="Serve Prometheus text metrics on this port (default: disabled)")
+    parser.add_argument("--metrics-host", default="127.0.0.1",
+                        help="Address for the metrics endpoint (default: 127.0.0.1)")
+    parser.add_argument("--log-summary-interval", type=float, default=0,
+                        help="Log aggregated traffic every N seconds and only log per-connection "
+                             "lines at WARNING and above (default: 0, per-connection INFO logging)")
+    parsed = parser.parse_args(args)
+
+    defaults = {name: getattr(parsed, name) for name in Route.OPTIONS}
+    addresses = (parsed.local_ip, parsed.local_port, parsed.remote_cid, parsed.remote_port)
+    try:
+        if parsed.config:
+            if any(value is not None for value in addresses):
+                parser.error("use either --config or <local_ip> <local_port> <remote_cid> <remote_port>, not both")
+            return parsed, load_routes(parsed.config, defaults)
+        if any(value is None for value in addresses):
+            parser.error("<local_ip> <local_port> <remote_cid> <remote_port> are required without --config")
+        return parsed, [Route(*addresses, **defaults)]
+    except (OSError, ValueError) as e:
+        parser.error(str(e))
+
 def main(args):
-    if len(args) < 4:
-        logging.error("Usage: python traffic_forwarder.py <local_ip> <local_port> <remote_cid> <remote_port>")
-        sys.exit(1)
-        
-    local_ip = str(args[0])
-    local_port = int(args[1])
-    remote_cid = int(args[2])
-    remote_port = int(args[3])
-    
-    logging.info(f"Starting forwarder on {local_ip}:{local_port} to {remote_cid}:{remote_port}")
-    
+    options, routes = parse_args(args)
+
+    for route in routes:
+        logging.info(f"Starting forwarder on {route.local} to {route.remote}")
+
     # Run server (will block until shutdown)
-    server(local_ip, local_port, remote_cid, remote_port)
-    
+    if len(routes) == 1 and routes[0].workers == 1:
+        if options.metrics_port:
+            serve_metrics(options.metrics_host, options.metrics_port, lambda: metrics.render(metrics.snapshot()))
+        run_route(routes[0], options.log_summary_interval)
+    else:
+        supervise(routes, options)
+
     logging.info("Traffic forwarder exiting")
 
 if __name__ == '__main__':
@@ -2,83 +2,437 @@ import socket
 import sys
 import time
 import json
-import select
+import struct
+import argparse
+import copy
+import random
+import itertools
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 from contextlib import closing
 
-def vsock_request(cid, port, request, max_retries=5, retry_delay=10, initial_delay=5):
-    print(f"Waiting {initial_delay} seconds before first attempt...", file=sys.stderr)
-    time.sleep(initial_delay)
+try:
+    from instrumentation import setup as setup_instrumentation, timed
+except ImportError:  # Profiling hooks are optional, see instrumentation.py
+    def setup_instrumentation(service):
+        return None
 
-    for attempt in range(max_retries):
+    def timed(name):
+        return lambda func: func
+
+# How the end of the response is detected: "json" stops as soon as a complete
+# JSON document has arrived, "length" speaks credential_requester's framed
+# protocol (preamble, then 4-byte big-endian length-prefixed messages) and
+# "close" reads until the peer closes or goes quiet for the response timeout
+FRAMINGS = ("json", "length", "close")
+PROTOCOL_PREAMBLE = b"NTF\x01"
+FRAME_HEADER = struct.Struct(">I")
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+JSON_END = frozenset(b"}]")
+WHITESPACE = frozenset(b" \t\r\n")
+
+def json_complete(buffer, length):
+    """True if buffer[:length] holds a whole JSON object or array"""
+    end = length
+    while end and buffer[end - 1] in WHITESPACE:
+        end -= 1
+    if not end or buffer[end - 1] not in JSON_END:
+        return False
+    try:
+        json.loads(bytes(buffer[:end]))
+        return True
+    except ValueError:
+        return False
+
+def receive(sock, framing, log, expected=None):
+    """Read a response into a growing bytearray with recv_into; returns bytes.
+
+    Stops at EOF, at the end of a JSON document (framing "json"), once
+    expected bytes have arrived, or when the socket times out.
+    """
+    buffer = bytearray(65536)
+    length = 0
+    chunk_count = 0
+    while expected is None or length < expected:
+        if length == len(buffer):
+            buffer.extend(bytes(len(buffer)))
+        try:
+            with memoryview(buffer) as view:
+                received = sock.recv_into(view[length:] if expected is None else view[length:expected])
+        except socket.timeout:
+            log("Receive timeout, ending reception")
+            break
+        if not received:
+            log("Received empty chunk, ending reception")
+            break
+        length += received
+        chunk_count += 1
+        log(f"Received chunk {chunk_count} of length {received}, total {length}")
+        if framing == "json" and json_complete(buffer, length):
+            break
+    return bytes(buffer[:length])
+
+@timed("vsock_exchange")
+def exchange(sock, request, framing, log):
+    if framing != "length":
+        sock.sendall(request.encode())
+        return receive(sock, framing, log)
+
+    message = json.loads(request)
+    if not isinstance(message, dict):
+        raise ValueError("Request is not a JSON object")
+    message["id"] = 1
+    payload = json.dumps(message).encode()
+    sock.sendall(PROTOCOL_PREAMBLE + FRAME_HEADER.pack(len(payload)) + payload)
+    header = receive(sock, framing, log, expected=FRAME_HEADER.size)
+    if len(header) < FRAME_HEADER.size:
+        return b""
+    (length,) = FRAME_HEADER.unpack(header)
+    body = receive(sock, framing, log, expected=length)
+    if len(body) < length:
+        return b""
+    # Callers get the same document as from the one-shot protocol
+    response = json.loads(body)
+    response.pop("id", None)
+    return json.dumps(response).encode()
+
+class RetryPolicy:
+    """How vsock_request() connects, waits and retries.
+
+    Waits between attempts start at initial_backoff and grow by multiplier
+    up to max_backoff; jitter scales each one down by a random fraction of
+    up to that much, so callers that fail together do not retry in lockstep.
+    Connection failures during the first ready_timeout seconds mean the peer
+    is still starting and do not count towards max_attempts. No attempt
+    starts after deadline seconds; by default that is the only limit, so a
+    peer that stays away is retried for a minute, roughly as long as the
+    old five attempts ten seconds apart, with more, quicker attempts.
+    """
+    def __init__(self, max_attempts=None, initial_backoff=0.05, max_backoff=5, multiplier=2, jitter=0.5,
+                 deadline=60, ready_timeout=0, connect_timeout=10, response_timeout=5):
+        self.max_attempts = max_attempts
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.multiplier = multiplier
+        self.jitter = jitter
+        self.deadline = deadline
+        self.ready_timeout = ready_timeout
+        self.connect_timeout = connect_timeout
+        self.response_timeout = response_timeout
+        # Seconds until the peer first accepted a connection, set by vsock_request()
+        self.last_ready_seconds = None
+
+    def replace(self, **changes):
+        policy = copy.copy(self)
+        for name, value in changes.items():
+            setattr(policy, name, value)
+        return policy
+
+    def out_of_attempts(self, attempts):
+        return self.max_attempts is not None and attempts >= self.max_attempts
+
+    def backoffs(self):
+        backoff = self.initial_backoff
+        while True:
+            yield backoff * (1 - self.jitter * random.random())
+            backoff = min(backoff * self.multiplier, self.max_backoff)
+
+def vsock_request(cid, port, request, max_retries=None, retry_delay=None, initial_delay=None,
+                  framing="json", idle_timeout=None, verbose=False, policy=None):
+    """Send request and return the decoded response.
+
+    Retries follow policy (a RetryPolicy). The older keyword arguments
+    override it: max_retries sets max_attempts, retry_delay a fixed wait
+    without jitter, initial_delay the ready_timeout and idle_timeout the
+    response_timeout. Progress details are printed to stderr when verbose.
+    """
+    policy = policy or RetryPolicy()
+    if max_retries is not None:
+        policy = policy.replace(max_attempts=max_retries)
+    if retry_delay is not None:
+        policy = policy.replace(initial_backoff=retry_delay, max_backoff=retry_delay, jitter=0)
+    if initial_delay is not None:
+        policy = policy.replace(ready_timeout=initial_delay)
+    if idle_timeout is not None:
+        policy = policy.replace(response_timeout=idle_timeout)
+
+    def log(message):
+        if verbose:
+            print(message, file=sys.stderr)
+
+    start = time.monotonic()
+    backoffs = policy.backoffs()
+    attempts = 0
+    connects = 0
+    ready = False
+    while True:
+        connects += 1
+        starting = time.monotonic() - start < policy.ready_timeout
         try:
             with closing(socket.socket(socket.AF_VSOCK, socket.SOCK_STREAM)) as sock:
-                print(f"Attempt {attempt + 1}: Connecting to CID {cid}, port {port}...", file=sys.stderr)
-                sock.settimeout(60)  # 60 seconds timeout
-                connect_start = time.time()
+                log(f"Connecting to CID {cid}, port {port}...")
+                sock.settimeout(policy.connect_timeout)
                 sock.connect((cid, port))
-                connect_time = time.time() - connect_start
-                print(f"Connected in {connect_time:.2f} seconds", file=sys.stderr)
-
-                print("Sending request...", file=sys.stderr)
-                sock.sendall(request.encode())
-                
-                print("Receiving response...", file=sys.stderr)
-                response = b""
-                chunk_count = 0
-                while True:
-                    ready = select.select([sock], [], [], 5)  # 5 second timeout
-                    if ready[0]:
-                        try:
-                            chunk = sock.recv(4096)
-                            chunk_count += 1
-                            print(f"Received chunk {chunk_count} of length {len(chunk)}", file=sys.stderr)
-                            if chunk:
-                                response += chunk
-                                print(f"Total response length after chunk {chunk_count}: {len(response)}", file=sys.stderr)
-                            else:
-                                print("Received empty chunk, ending reception", file=sys.stderr)
-                                break
-                        except socket.error as e:
-                            print(f"Socket error while receiving: {e}", file=sys.stderr)
-                            break
+                if not ready:
+                    ready = True
+                    policy.last_ready_seconds = time.monotonic() - start
+                    message = f"Peer ready after {policy.last_ready_seconds:.3f} seconds ({connects} connects)"
+                    if connects > 1:
+                        print(message, file=sys.stderr)
                     else:
-                        print("Receive timeout, ending reception", file=sys.stderr)
-                        break
+                        log(message)
+                starting = False
+                sock.settimeout(policy.response_timeout)
+
+                log("Sending request...")
+                response = exchange(sock, request, framing, log)
 
                 if response:
-                    print(f"Received complete response of length {len(response)}", file=sys.stderr)
+                    log(f"Received complete response of length {len(response)}")
                     try:
-                        decoded_response = response.decode()
-                        print(f"Decoded response length: {len(decoded_response)}", file=sys.stderr)
-                        return decoded_response
+                        return response.decode()
                     except UnicodeDecodeError as e:
                         print(f"Error decoding response: {e}", file=sys.stderr)
                         print(f"Raw response: {response}", file=sys.stderr)
                         raise
                 else:
                     print("No response received, retrying...", file=sys.stderr)
-                    continue
 
         except (OSError, socket.error) as e:
-            print(f"Connection error on attempt {attempt + 1}: {str(e)}", file=sys.stderr)
-        
-        if attempt < max_retries - 1:
-            print(f"Retrying in {retry_delay} seconds...", file=sys.stderr)
-            time.sleep(retry_delay)
+            if starting:
+                log(f"Peer not ready yet: {e}")
+            else:
+                print(f"Connection error on attempt {attempts + 1}: {str(e)}", file=sys.stderr)
+
+        if not starting:
+            attempts += 1
+        delay = next(backoffs)
+        out_of_time = policy.deadline is not None and time.monotonic() - start + delay > policy.deadline
+        if policy.out_of_attempts(attempts) or out_of_time:
+            reason = "Max retries" if policy.out_of_attempts(attempts) else "Deadline"
+            print(f"{reason} reached. Returning error JSON.", file=sys.stderr)
+            return json.dumps({"error": f"VSOCK connection failed after {attempts} attempts"})
+        if starting:
+            log(f"Retrying in {delay:.2f} seconds...")
         else:
-            print("Max retries reached. Returning error JSON.", file=sys.stderr)
-            return json.dumps({"error": f"VSOCK connection failed after {max_retries} attempts"})
+            print(f"Retrying in {delay:.2f} seconds...", file=sys.stderr)
+        time.sleep(delay)
+
+def open_connection(cid, port, policy, log):
+    """Connect within policy's attempts and deadline; returns the socket or None"""
+    start = time.monotonic()
+    backoffs = policy.backoffs()
+    attempts = 0
+    while True:
+        starting = time.monotonic() - start < policy.ready_timeout
+        sock = socket.socket(socket.AF_VSOCK, socket.SOCK_STREAM)
+        try:
+            sock.settimeout(policy.connect_timeout)
+            sock.connect((cid, port))
+            policy.last_ready_seconds = time.monotonic() - start
+            return sock
+        except OSError as e:
+            sock.close()
+            log(f"Connection attempt failed: {e}")
+        if not starting:
+            attempts += 1
+        delay = next(backoffs)
+        if policy.out_of_attempts(attempts) or (policy.deadline is not None and
+                                                time.monotonic() - start + delay > policy.deadline):
+            return None
+        time.sleep(delay)
+
+def multiplex(cid, port, requests, window, policy, log, pending):
+    """Send (index, request) pairs over one framed connection and yield
+    (index, response, seconds) as responses arrive, with up to window
+    requests in flight.
+
+    Requests sent but not answered are left in pending when the connection
+    fails or the peer does not speak the framed protocol.
+    """
+    sock = open_connection(cid, port, policy, log)
+    if sock is None:
+        print("Could not open a persistent connection", file=sys.stderr)
+        return
+    sent = {}
+    with closing(sock):
+        try:
+            sock.settimeout(policy.response_timeout)
+            sock.sendall(PROTOCOL_PREAMBLE)
+            exhausted = False
+            while True:
+                while not exhausted and len(sent) < window:
+                    item = next(requests, None)
+                    if item is None:
+                        exhausted = True
+                        break
+                    index, request = item
+                    try:
+                        message = json.loads(request)
+                        message["id"] = index
+                    except (ValueError, TypeError):
+                        yield index, json.dumps({"error": "Request is not a JSON object"}), 0.0
+                        continue
+                    pending[index] = request
+                    payload = json.dumps(message).encode()
+                    sock.sendall(FRAME_HEADER.pack(len(payload)) + payload)
+                    sent[index] = time.monotonic()
+                if not sent:
+                    return
+
+                header = receive(sock, "length", log, expected=FRAME_HEADER.size)
+                if len(header) < FRAME_HEADER.size:
+                    print("Persistent connection closed with requests outstanding", file=sys.stderr)
+                    return
+                (length,) = FRAME_HEADER.unpack(header)
+                if length > MAX_FRAME_SIZE:
+                    print("Peer does not speak the framed protocol", file=sys.stderr)
+                    return
+                body = receive(sock, "length", log, expected=length)
+                if len(body) < length:
+                    print("Persistent connection closed with requests outstanding", file=sys.stderr)
+                    return
+                response = json.loads(body)
+                index = response.pop("id", None)
+                if index not in sent:
+                    print(f"Unexpected response on persistent connection: {response}", file=sys.stderr)
+                    return
+                seconds = time.monotonic() - sent.pop(index)
+                del pending[index]
+                yield index, json.dumps(response), seconds
+        except (OSError, ValueError) as e:
+            print(f"Persistent connection failed: {e}", file=sys.stderr)
+
+def vsock_requests(cid, port, requests, concurrency=8, persistent=False, framing="json", verbose=False, policy=None):
+    """Send every request in the iterable requests and yield the results in completion order.
+
+    Each result is a dict with the request's position in requests ("index"),
+    the seconds it took and the response, decoded from JSON where possible.
+    Up to concurrency requests run at once on their own connections, or with
+    persistent=True over one connection in credential_requester's framed
+    protocol; whatever that connection leaves unanswered is then sent on
+    separate connections.
+    """
+    policy = policy or RetryPolicy()
+
+    def log(message):
+        if verbose:
+            print(message, file=sys.stderr)
+
+    def result(index, response, seconds):
+        try:
+            response = json.loads(response)
+        except ValueError:
+            pass
+        return {"index": index, "seconds": round(seconds, 6), "response": response}
+
+    def run_one(index, request):
+        start = time.monotonic()
+        try:
+            response = vsock_request(cid, port, request, framing=framing, verbose=verbose, policy=policy)
+        except (ValueError, TypeError) as e:
+            # Requests that are not JSON objects with framing "length", or responses that are not text
+            response = json.dumps({"error": str(e)})
+        return result(index, response, time.monotonic() - start)
+
+    requests = enumerate(requests)
+    if persistent:
+        pending = {}
+        for index, response, seconds in multiplex(cid, port, requests, concurrency, policy, log, pending):
+            yield result(index, response, seconds)
+        if pending:
+            print(f"Resending {len(pending)} unanswered requests on separate connections", file=sys.stderr)
+        requests = itertools.chain(sorted(pending.items()), requests)
+
+    with ThreadPoolExecutor(concurrency) as executor:
+        running = set()
+        for index, request in requests:
+            if len(running) >= concurrency:
+                done, running = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+            running.add(executor.submit(run_one, index, request))
+        while running:
+            done, running = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+
+def read_requests(stream):
+    """Yield the non-blank lines of a JSONL stream, stripped"""
+    for line in stream:
+        line = line.strip()
+        if line:
+            yield line
+
+def run_batch(args, policy):
+    """Stream results for a JSONL request file as JSONL on stdout, then summarize timings on stderr"""
+    stream = sys.stdin if args.batch == "-" else open(args.batch)
+    start = time.monotonic()
+    timings = []
+    errors = 0
+    with stream:
+        for result in vsock_requests(args.cid, args.port, read_requests(stream), concurrency=args.concurrency,
+                                     persistent=args.persistent, framing=args.framing, verbose=args.verbose,
+                                     policy=policy):
+            print(json.dumps(result), flush=True)
+            timings.append(result["seconds"])
+            if isinstance(result["response"], dict) and "error" in result["response"]:
+                errors += 1
+    elapsed = time.monotonic() - start
+    if not timings:
+        print("No requests", file=sys.stderr)
+        return
+    timings.sort()
+    def percentile(fraction):
+        return timings[min(len(timings) - 1, int(len(timings) * fraction))] * 1000
+    print(f"{len(timings)} requests, {errors} errors in {elapsed:.3f} seconds "
+          f"({len(timings) / elapsed:.1f}/s); latency p50 {percentile(0.5):.1f} ms, "
+          f"p99 {percentile(0.99):.1f} ms, max {timings[-1] * 1000:.1f} ms", file=sys.stderr)
 
 if __name__ == "__main__":
-    if len(sys.argv) != 4:
-        print("Usage: python vsock_helper.py <cid> <port> <request>", file=sys.stderr)
-        sys.exit(1)
-    
-    cid = int(sys.argv[1])
-    port = int(sys.argv[2])
-    request = sys.argv[3]
-    
-    response = vsock_request(cid, port, request)
-    
-    # Print only the JSON response to stdout
-    print(response)
+    parser = argparse.ArgumentParser(description="Send one request over VSOCK and print the response")
+    parser.add_argument("cid", type=int, help="CID to connect to")
+    parser.add_argument("port", type=int, help="VSOCK port to connect to")
+    parser.add_argument("request", nargs="?", help="Request to send, usually JSON")
+    parser.add_argument("--batch", metavar="FILE",
+                        help="Send every line of a JSONL file (- for stdin) instead of one request and "
+                             "print the results as JSONL in completion order")
+    parser.add_argument("--concurrency", type=int, default=8,
+                        help="Requests in flight at once in batch mode (default: 8)")
+    parser.add_argument("--persistent", action="store_true",
+                        help="In batch mode, send all requests over one connection in the framed protocol")
+    parser.add_argument("--framing", choices=FRAMINGS, default="json",
+                        help="How the end of the response is detected (default: json)")
+    parser.add_argument("--max-attempts", type=int, default=None,
+                        help="Failed attempts before giving up (default: no limit, only --deadline)")
+    parser.add_argument("--deadline", type=float, default=60,
+                        help="Give up after this many seconds overall (default: 60)")
+    parser.add_argument("--wait-ready", type=float, default=0, metavar="SECONDS",
+                        help="Connection failures in the first SECONDS do not count as attempts (default: 0)")
+    parser.add_argument("--initial-backoff", type=float, default=0.05,
+                        help="First wait between attempts in seconds (default: 0.05)")
+    parser.add_argument("--max-backoff", type=float, default=5,
+                        help="Longest wait between attempts in seconds (default: 5)")
+    parser.add_argument("--jitter", type=float, default=0.5,
+                        help="Randomly shorten each wait by up to this fraction (default: 0.5)")
+    parser.add_argument("--connect-timeout", type=float, default=10,
+                        help="Seconds to wait for a connection (default: 10)")
+    parser.add_argument("--response-timeout", "--idle-timeout", type=float, default=5,
+                        help="Give up on a response after this many seconds of silence (default: 5)")
+    parser.add_argument("-v", "--verbose", action="store_true", help="Print progress details to stderr")
+    args = parser.parse_args()
+    setup_instrumentation("vsock_helper")
+    if (args.request is None) == (args.batch is None):
+        parser.error("give either a request or --batch FILE")
+
+    policy = RetryPolicy(max_attempts=args.max_attempts, initial_backoff=args.initial_backoff,
+                         max_backoff=args.max_backoff, jitter=args.jitter, deadline=args.deadline,
+                         ready_timeout=args.wait_ready, connect_timeout=args.connect_timeout,
+                         response_timeout=args.response_timeout)
+    if args.batch:
+        run_batch(args, policy)
+    else:
+        response = vsock_request(args.cid, args.port, args.request, framing=args.framing,
+                                 verbose=args.verbose, policy=policy)
+
+        # Print only the JSON response to stdout
+        print(response)